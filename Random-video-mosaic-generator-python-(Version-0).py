@@ -1,130 +1,74 @@
+from mosaic.startup import preload, window_shown  # Первым: от этого импорта отсчитывается время запуска
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import numpy as np
-import pygame
 from threading import Thread
-from PIL import Image, ImageTk
-from moviepy.editor import VideoFileClip
-import random
-from pydub import AudioSegment
-import time
-import tempfile
-import os
-import cv2
-
-class AudioMosaic:
-    def __init__(self):
-        self.segments = []
-        self.sample_rate = 0
-        self.is_playing = False
-        pygame.mixer.init()
-
-    def convert_audio_to_segments(self, audio, segment_duration_ms=500):
-        self.segments = []
-        current_time = 0
-
-        while current_time < len(audio):
-            segment = audio[current_time:current_time + segment_duration_ms]
-            self.segments.append(segment.raw_data)
-            current_time += segment_duration_ms
-        
-        self.sample_rate = audio.frame_rate
-
-    def mix_audio_segments(self):
-        random.shuffle(self.segments)
-        return b''.join(self.segments)
-
-    def play_audio(self):
-        self.is_playing = True
-        while self.is_playing:
-            shuffled_audio = self.mix_audio_segments()
-            sound_array = np.frombuffer(shuffled_audio, dtype=np.int16)
-            pygame.mixer.Sound(buffer=sound_array).play()
-
-            # Даем время на воспроизведение сегментов
-            time.sleep(len(shuffled_audio) / (self.sample_rate * 2))
-
-    def stop_audio(self):
-        self.is_playing = False
-        pygame.mixer.stop()
+import queue
+from mosaic.audio import AudioMosaic, extract_audio
+from mosaic.pcm_cache import PcmCache
+from mosaic.readers import ReaderPool
+from mosaic.tiles import shuffle_grid
+from mosaic.blur import blur_frame
+from mosaic.frame_cache import FrameCache
+from mosaic.display import CanvasDisplay
+from mosaic.metrics import start_metrics
+from mosaic.navigation import Navigator
 
 video_clips = []
+reader_pool = ReaderPool()  # Не больше 16 открытых декодеров, давно не нужные закрываются
 audio_mosaic = AudioMosaic()
+pcm_cache = PcmCache()  # Звук уже встречавшихся клипов берется с диска
+frame_cache = FrameCache(budget_mb=256)  # Уменьшенные кадры всех клипов
+loaded_videos = queue.Queue()  # Клипы, прочитанные фоновым потоком, ждут добавления в окно
 
-current_frame_index = 0
 move_speed = 1  # Скорость перемещения
 
 def load_videos():
-    global video_clips
     video_paths = filedialog.askopenfilenames(title="Выберите видео файлы", filetypes=[("Video files", "*.mp4;*.avi;*.mov")])
     if video_paths:
-        for video_path in video_paths:
-            video_clip = VideoFileClip(video_path)
-            video_clips.append((video_path, video_clip))
-            video_listbox.insert(tk.END, video_path)
-
-def shuffle_frame(frame, iterations=6):
-    plitkorez = 6  # Количество плиток по каждой оси
-    height, width, _ = frame.shape
-    h, w = height // plitkorez, width // plitkorez
-    
-    tiles = []
-    for i in range(plitkorez):
-        for j in range(plitkorez):
-            y_start = i * h
-            y_end = (i + 1) * h if (i + 1) * h < height else height
-            x_start = j * w
-            x_end = (j + 1) * w if (j + 1) * w < width else width
-            tiles.append(frame[y_start:y_end, x_start:x_end])
-
-    random.shuffle(tiles)
-
-    reshuffled_frame = []
-    for i in range(plitkorez):
-        reshuffled_frame.append(np.hstack(tiles[i * plitkorez:(i + 1) * plitkorez]))
-
-    return np.vstack(reshuffled_frame)
-
-def display_frame(frame_index):
-    global current_frame_index
-    if video_clips:
-        video_clip = video_clips[current_frame_index][1]
-        if frame_index >= video_clip.duration * video_clip.fps:  # Проверка на границу
-            frame_index = 0
-        frame = video_clip.get_frame(frame_index / video_clip.fps)
-        frame_array = np.array(Image.fromarray(frame).resize((640, 480), Image.LANCZOS))
-
-        # Перемешиваем плитки
-        shuffled_frame = shuffle_frame(frame_array)
-
-        # Применяем размытие
-        blurred_frame = cv2.GaussianBlur(shuffled_frame, (41, 41), 0)
-
-        # Преобразуем в изображение для tkinter
-        blurred_frame_photo = ImageTk.PhotoImage(Image.fromarray(blurred_frame))
-
-        # Отображаем изображение
-        canvas.create_image(0, 0, anchor=tk.NW, image=blurred_frame_photo)
-        canvas.image = blurred_frame_photo
+        # Метаданные читает ffmpeg, для сотен клипов это минуты: в фоне, список в окне пополняется по мере готовности
+        Thread(target=probe_videos, args=(video_paths,), daemon=True).start()
+        root.after(100, show_loaded_videos)
+
+def probe_videos(video_paths):  # Вызывается в фоновом потоке
+    # Только метаданные, декодер откроется при чтении
+    for video_path, video_clip, error in reader_pool.add_all(video_paths):
+        loaded_videos.put((video_path, video_clip, error))
+    loaded_videos.put(None)
+
+def show_loaded_videos():  # В потоке Tk: клипы, у которых уже прочитаны метаданные
+    failed = []
+    while True:
+        try:
+            loaded = loaded_videos.get_nowait()
+        except queue.Empty:
+            root.after(100, show_loaded_videos)
+            break
+        if loaded is None:
+            break
+        video_path, video_clip, error = loaded
+        if error is not None:
+            failed.append(video_path)
+            continue
+        video_clips.append((video_path, video_clip))  # Тот же список у navigator: новые клипы видны сразу
+        video_listbox.insert(tk.END, video_path)
+    if failed:
+        messagebox.showwarning("Предупреждение", "Не удалось открыть:\n" + "\n".join(failed))
+
+def mosaic_image(frame_array):  # Вызывается из потоков подготовки кадров
+    # Перемешиваем плитки
+    shuffled_frame = shuffle_grid(frame_array, 6, 6)  # 6 плиток по каждой оси
+
+    # Применяем размытие
+    return blur_frame(shuffled_frame, 41)
+
+def show_frame_error(position, error):  # Кадр, на который перешли, не удалось подготовить
+    clip, frame = position
+    root.title("Генератор случайного видео (кадр %d клипа %d не открылся: %s)" % (frame, clip + 1, error))
 
 def move_camera(direction):
-    global current_frame_index
-    if direction == "F":  # Вперед
-        current_frame_index += move_speed
-    elif direction == "B":  # Назад
-        current_frame_index -= move_speed
-    elif direction == "L":  # Сменить на предыдущее видео
-        current_frame_index = max(0, current_frame_index - 1)
-    elif direction == "R":  # Сменить на следующее видео
-        current_frame_index = min(len(video_clips) - 1, current_frame_index + 1)
-
-    # Проверяем, чтобы индекс не выходил за пределы
-    if current_frame_index < 0:
-        current_frame_index = 0
-    elif current_frame_index >= len(video_clips):
-        current_frame_index = len(video_clips) - 1
-
-    display_frame(current_frame_index)
+    # "F"/"B" - вперед/назад по кадрам клипа, "L"/"R" - предыдущий/следующий клип.
+    # Кадр берется из заготовленных заранее, декодирование идет в фоне
+    navigator.move(direction)
 
 def on_key_press(event):
     key = event.keysym
@@ -137,27 +81,27 @@ def on_key_press(event):
     elif key == 'd':
         move_camera("R")
 
+def show_audio_progress(audio_extractor):
+    done, total = audio_extractor.progress()
+    if done < total:
+        root.title("Генератор случайного видео (звук %d/%d)" % (done, total))
+        root.after(200, show_audio_progress, audio_extractor)
+    else:
+        root.title("Генератор случайного видео")
+
 def start_video():
     global video_clips
     if not video_clips:
         messagebox.showwarning("Предупреждение", "Выберите видео файлы сначала.")
         return
 
-    audio_segments = []
-    for video_path, video_clip in video_clips:
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio_file:
-            audio_path = temp_audio_file.name
-            video_clip.audio.write_audiofile(audio_path)
-            audio_segment = AudioSegment.from_file(audio_path)
-
-            audio_segments.append(audio_segment)
-
-        os.remove(audio_path)  # Удаляем файл после использования
-
-    combined_audio = sum(audio_segments)
-    audio_mosaic.convert_audio_to_segments(combined_audio)
+    # Звук всех клипов извлекается параллельно, играть начинаем, как только готов первый
+    audio_extractor = extract_audio(audio_mosaic, [(video_path, video_clip.audio_duration)
+                                                   for video_path, video_clip in video_clips
+                                                   if video_clip.audio_duration is not None], cache=pcm_cache)
+    show_audio_progress(audio_extractor)
     Thread(target=audio_mosaic.play_audio, daemon=True).start()  
-    display_frame(current_frame_index)  # Начальное отображение кадра
+    navigator.show()  # Начальное отображение кадра, соседние готовятся в фоне
 
 # Создание графического интерфейса
 root = tk.Tk()
@@ -165,6 +109,9 @@ root.title("Генератор случайного видео")
 
 canvas = tk.Canvas(root, width=640, height=480)
 canvas.pack()
+frame_display = CanvasDisplay(canvas)  # Одно изображение на холсте, обновляется на месте
+navigator = Navigator(canvas, video_clips, frame_cache, mosaic_image, frame_display.show, move_speed,
+                      report_error=show_frame_error)
 
 video_listbox = tk.Listbox(root, width=80, height=10)
 video_listbox.pack()
@@ -177,5 +124,9 @@ start_button.pack()
 
 root.bind("<KeyPress>", on_key_press)  # Привязываем обработчик к событиям клавиш
 
+window_shown(root)  # Время до появления окна попадает в замеры (startup_window)
+preload()  # moviepy, OpenCV и pygame грузятся в фоне, пока окно уже на экране
+start_metrics()  # Замеры этапов: http://127.0.0.1:9464/metrics, журнал и профилировщик - см. README
+
 # Запустить основной цикл интерфейса
 root.mainloop()
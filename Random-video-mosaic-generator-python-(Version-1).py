@@ -1,38 +1,25 @@
+from mosaic.startup import preload, window_shown  # Первым: от этого импорта отсчитывается время запуска
 import tkinter as tk
 from tkinter import filedialog
 import numpy as np
-import pygame
 from threading import Thread
-from PIL import Image, ImageTk
-from moviepy.editor import VideoFileClip
 import random
-import cv2
+from mosaic.audio import AudioMosaic, extract_audio
+from mosaic.frames import open_clip, resize_frame
+from mosaic.display import CanvasDisplay
+from mosaic.metrics import start_metrics
+from mosaic.scheduler import FrameScheduler, display_fps
 
+FPS = display_fps()  # Частота показа кадров, по умолчанию 1 в секунду
 video_clip = None
 audio_clip = None
+audio_mosaic = AudioMosaic()  # Случайные куски звука клипа блоками по 40 мс, с переходами на стыках
 
 def load_video(video_path):
     global video_clip, audio_clip
-    video_clip = VideoFileClip(video_path)
+    video_clip = open_clip(video_path)  # Декодер сразу отдает кадры 640x480
     audio_clip = video_clip.audio
 
-def play_sound():
-    global audio_clip
-    sample_rate = 44100
-    pygame.mixer.init(frequency=sample_rate, size=-16, channels=1)
-
-    while True:
-        start_time = random.uniform(0, audio_clip.duration - 1)
-        end_time = min(start_time + 1, audio_clip.duration)  # 1-секундный фрагмент
-
-        audio_segment = audio_clip.subclip(start_time, end_time)
-        audio_segment_array = audio_segment.to_soundarray(fps=sample_rate)
-
-        sound = (audio_segment_array * 32767).astype(np.int16)
-        pygame.mixer.Sound(buffer=sound.tobytes()).play()
-
-        pygame.time.delay(1000)  # Пауза на 1 секунду перед воспроизведением следующего
-
 def shuffle_frame(frame):
     height, width, _ = frame.shape
 
@@ -55,43 +42,24 @@ def shuffle_frame(frame):
 
     return shuffled_frame
 
-def display_random_frame():
+def next_mosaic_frame():  # Вызывается из потока подготовки кадров
     if video_clip:
         start_time = random.uniform(0, video_clip.duration - 1)
         frame = video_clip.get_frame(start_time)
 
-        # Преобразование массива в изображение PIL
-        frame_image = Image.fromarray(frame)
-
-        # Изменение размера изображения, чтобы оно подходило под canvas
-        frame_image = frame_image.resize((640, 480), Image.LANCZOS)  # Масштабируем изображение с использованием LANCZOS
-
-        # Преобразование изображения PIL в массив numpy
-        frame_array = np.array(frame_image)
+        # Кадр уже уменьшен декодером, resize_frame только проверяет размер
+        frame_array = resize_frame(frame)
 
         # Перемешивание кадра
-        shuffled_frame = shuffle_frame(frame_array)
-
-        # Преобразование массива numpy обратно в изображение PIL
-        shuffled_frame_image = Image.fromarray(shuffled_frame)
-
-        # Изменение размера изображения, чтобы оно подходило под canvas
-        shuffled_frame_image = shuffled_frame_image.resize((640, 480), Image.LANCZOS)  # Масштабируем изображение с использованием LANCZOS
-
-        # Преобразование изображения PIL в изображение PhotoImage
-        shuffled_frame_photo = ImageTk.PhotoImage(shuffled_frame_image)
-
-        # Обновление canvas с новым изображением
-        canvas.create_image(0, 0, anchor=tk.NW, image=shuffled_frame_photo)
-        canvas.image = shuffled_frame_photo  # Сохранение ссылки на изображение, чтобы избежать сборки мусора
-
-    # Запланировать обновление через 1000 мс (1 секунда)
-    canvas.after(1000, display_random_frame)
+        return shuffle_frame(frame_array)
 
 def start_audio_and_video(video_path):
     load_video(video_path)
-    Thread(target=play_sound, daemon=True).start()  # Запуск звука в отдельном потоке
-    display_random_frame()  # Запуск отображения случайных кадров
+    if audio_clip is not None:
+        # Звук извлекается один раз целиком, а не отдельным ffmpeg на каждый кусок
+        extract_audio(audio_mosaic, [(video_path, audio_clip.duration)])
+        Thread(target=audio_mosaic.play_audio, daemon=True).start()  # Запуск звука в отдельном потоке
+    frame_scheduler.start()  # Запуск отображения случайных кадров
 
 def select_video():
     file_path = filedialog.askopenfilename(title="Выберите видео файл")  
@@ -104,9 +72,15 @@ root.title("Random EVP Video Generator")
 
 canvas = tk.Canvas(root, width=640, height=480)
 canvas.pack()
+frame_display = CanvasDisplay(canvas)  # Одно изображение на холсте, обновляется на месте
+frame_scheduler = FrameScheduler(canvas, next_mosaic_frame, frame_display.show, fps=FPS)  # Показ по сроку, кадры готовятся заранее
 
 select_button = tk.Button(root, text="Выбрать видео", command=select_video)
 select_button.pack()
 
+window_shown(root)  # Время до появления окна попадает в замеры (startup_window)
+preload()  # moviepy, OpenCV и pygame грузятся в фоне, пока окно уже на экране
+start_metrics()  # Замеры этапов: http://127.0.0.1:9464/metrics, журнал и профилировщик - см. README
+
 # Запустить основной цикл интерфейса
 root.mainloop()
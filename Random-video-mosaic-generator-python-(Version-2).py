@@ -1,61 +1,23 @@
+from mosaic.startup import preload, window_shown  # Первым: от этого импорта отсчитывается время запуска
 import tkinter as tk
 from tkinter import filedialog
 import numpy as np
-import pygame
 from threading import Thread
-from PIL import Image, ImageTk
-from moviepy.editor import VideoFileClip
 import random
-from pydub import AudioSegment
-import time
-
-class AudioMosaic:
-    def __init__(self):
-        self.segments = []
-        self.sample_rate = 0
-        self.is_playing = False
-        pygame.mixer.init()  # Инициализация pygame mixer при создании объекта
-
-    def convert_audio_to_segments(self, path, segment_duration_ms=500):
-        audio = AudioSegment.from_file(path)  # Загружаем аудиофайл
-        self.segments = []
-        current_time = 0
-
-        while current_time < len(audio):
-            segment = audio[current_time:current_time + segment_duration_ms]  # Получаем кусок аудио
-            self.segments.append(segment.raw_data)  # Добавляем сырье в список сегментов
-            current_time += segment_duration_ms  # Обновляем текущее время
-        
-        self.sample_rate = audio.frame_rate  # Сохраняем частоту дискретизации
-
-    def mix_audio_segments(self):
-        random.shuffle(self.segments)  # Перемешиваем сегменты
-        return b''.join(self.segments)  # Соединяем сегменты обратно в один поток байтов
-
-    def play_audio(self):
-        self.is_playing = True
-        while self.is_playing:
-            shuffled_audio = self.mix_audio_segments()  # Перемешиваем аудио каждый раз
-            
-            # Преобразование байтов в массив NumPy и создание звука
-            sound_array = np.frombuffer(shuffled_audio, dtype=np.int16)
-            pygame.mixer.Sound(buffer=sound_array).play()
-
-            # Даем время на воспроизведение сегментов
-            time.sleep(len(shuffled_audio) / (self.sample_rate * 2))  # Подсчет времени в секунды
-
-    def stop_audio(self):
-        self.is_playing = False  # Устанавливаем флаг в False
-        pygame.mixer.stop()  # Останавливаем воспроизведение музыки
+from mosaic.audio import AudioMosaic
+from mosaic.frames import open_clip, resize_frame
+from mosaic.display import CanvasDisplay
+from mosaic.metrics import start_metrics
+from mosaic.scheduler import FrameScheduler, display_fps
 
+FPS = display_fps()  # Частота показа кадров, по умолчанию 1 в секунду
 video_clip = None
-audio_mosaic = AudioMosaic()
+audio_mosaic = AudioMosaic()  # Перемешанные сегменты играются блоками по 40 мс, стоп - сразу
 video_playing = False
-last_shuffled_frame = None
 
 def load_video(video_path):
     global video_clip
-    video_clip = VideoFileClip(video_path)
+    video_clip = open_clip(video_path, audio=False)  # Декодер сразу отдает кадры 640x480, звук выбирается отдельно
 
 def shuffle_frame(frame):
     height, width, _ = frame.shape
@@ -74,20 +36,14 @@ def shuffle_frame(frame):
 
     return shuffled_frame
 
-def display_random_frame():
-    global last_shuffled_frame
+def next_mosaic_frame():  # Вызывается из потока подготовки кадров
     if video_clip and video_playing:
         start_time = random.uniform(0, video_clip.duration - 1)
         frame = video_clip.get_frame(start_time)
-        shuffled_frame = shuffle_frame(frame)  # Перемешиваем кадр
-        last_shuffled_frame = shuffled_frame  # Сохраняем перемешанный кадр
-        frame_array = np.array(Image.fromarray(shuffled_frame).resize((640, 480), Image.LANCZOS))
-        shuffled_frame_photo = ImageTk.PhotoImage(Image.fromarray(frame_array))
 
-        canvas.create_image(0, 0, anchor=tk.NW, image=shuffled_frame_photo)
-        canvas.image = shuffled_frame_photo
-
-    canvas.after(1000, display_random_frame)
+        # Кадр уже уменьшен декодером, resize_frame только проверяет размер
+        frame_array = resize_frame(frame)
+        return shuffle_frame(frame_array)
 
 def start_audio_mosaic():
     audio_file_path = filedialog.askopenfilename(
@@ -96,8 +52,11 @@ def start_audio_mosaic():
     )
     
     if audio_file_path:
-        audio_mosaic.convert_audio_to_segments(audio_file_path)  # Получаем сегменты состояния
-        Thread(target=audio_mosaic.play_audio, daemon=True).start()  # Запуск воспроизведения перемешанного аудио
+        from pydub import AudioSegment
+
+        audio_mosaic.convert_audio_to_segments(AudioSegment.from_file(audio_file_path))  # Получаем сегменты состояния
+        if not audio_mosaic.is_playing:
+            Thread(target=audio_mosaic.play_audio, daemon=True).start()  # Запуск воспроизведения перемешанного аудио
 
 def start_video():
     global video_playing
@@ -105,18 +64,16 @@ def start_video():
     if video_path:
         load_video(video_path)
         video_playing = True
-        display_random_frame()  # Запуск отображения случайных кадров
+        frame_scheduler.start()  # Запуск отображения случайных кадров
 
 def stop_video():
     global video_playing
     video_playing = False
+    frame_scheduler.stop()
     
     # Отображаем последний перемешанный кадр
-    if last_shuffled_frame is not None:
-        frame_array = np.array(Image.fromarray(last_shuffled_frame).resize((640, 480), Image.LANCZOS))
-        last_frame_photo = ImageTk.PhotoImage(Image.fromarray(frame_array))
-        canvas.create_image(0, 0, anchor=tk.NW, image=last_frame_photo)
-        canvas.image = last_frame_photo  # Чтобы предотвратить сборку мусора
+    if frame_scheduler.last_frame is not None:
+        frame_display.show(frame_scheduler.last_frame)
 
 # Создание графического интерфейса
 root = tk.Tk()
@@ -124,6 +81,8 @@ root.title("Генератор случайного видео и аудио")
 
 canvas = tk.Canvas(root, width=640, height=480)
 canvas.pack()
+frame_display = CanvasDisplay(canvas)  # Одно изображение на холсте, обновляется на месте
+frame_scheduler = FrameScheduler(canvas, next_mosaic_frame, frame_display.show, fps=FPS)  # Показ по сроку, кадры готовятся заранее
 
 select_video_button = tk.Button(root, text="Выбрать видео", command=start_video)
 select_video_button.pack()
@@ -137,5 +96,9 @@ stop_audio_button.pack()
 stop_video_button = tk.Button(root, text="Стоп видео", command=stop_video)
 stop_video_button.pack()
 
+window_shown(root)  # Время до появления окна попадает в замеры (startup_window)
+preload()  # moviepy, OpenCV и pygame грузятся в фоне, пока окно уже на экране
+start_metrics()  # Замеры этапов: http://127.0.0.1:9464/metrics, журнал и профилировщик - см. README
+
 # Запустить основной цикл интерфейса
 root.mainloop()
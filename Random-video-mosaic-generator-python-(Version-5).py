@@ -1,149 +1,170 @@
+from mosaic.startup import preload, window_shown  # Первым: от этого импорта отсчитывается время запуска
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import numpy as np
-import pygame
 from threading import Thread
-from PIL import Image, ImageTk
-from moviepy.editor import VideoFileClip
 import random
-from pydub import AudioSegment
-import tempfile
 import os
-import time
-import cv2  # Импортируем OpenCV
-
-class AudioMosaic:
-    def __init__(self):
-        self.segments = []
-        self.sample_rate = 0
-        self.is_playing = False
-        pygame.mixer.init()
-
-    def convert_audio_to_segments(self, audio, segment_duration_ms=500):
-        self.segments = []
-        current_time = 0
-
-        while current_time < len(audio):
-            segment = audio[current_time:current_time + segment_duration_ms]
-            self.segments.append(segment.raw_data)
-            current_time += segment_duration_ms
-        
-        self.sample_rate = audio.frame_rate
-
-    def mix_audio_segments(self):
-        random.shuffle(self.segments)
-        return b''.join(self.segments)
-
-    def play_audio(self):
-        self.is_playing = True
-        while self.is_playing:
-            shuffled_audio = self.mix_audio_segments()
-            sound_array = np.frombuffer(shuffled_audio, dtype=np.int16)
-            pygame.mixer.Sound(buffer=sound_array).play()
-
-            # Даем время на воспроизведение сегментов
-            time.sleep(len(shuffled_audio) / (self.sample_rate * 2))
-
-    def stop_audio(self):
-        self.is_playing = False
-        pygame.mixer.stop()
-
+import queue
+from mosaic.audio import AudioMosaic, extract_audio
+from mosaic.pcm_cache import PcmCache
+from mosaic.readers import ReaderPool
+from mosaic.tiles import shuffle_frame
+from mosaic.blur import blur_frame
+from mosaic.keyframes import SeekAwareSampler
+from mosaic.frame_cache import FrameCache
+from mosaic.compositor import TileCompositor
+from mosaic.pipeline import FramePipeline
+from mosaic.proxy import ProxyStore
+from mosaic.display import CanvasDisplay
+from mosaic.metrics import start_metrics
+from mosaic.scheduler import FrameScheduler, display_fps
+
+FPS = display_fps()  # Частота показа кадров, по умолчанию 1 в секунду
 video_clips = []
+reader_pool = ReaderPool()  # Не больше 16 открытых декодеров, давно не нужные закрываются
 audio_mosaic = AudioMosaic()
+pcm_cache = PcmCache()  # Звук уже встречавшихся клипов берется с диска
+frame_sampler = SeekAwareSampler()  # Выбирает время кадров рядом с ключевыми кадрами
+frame_cache = FrameCache(budget_mb=256)  # Уменьшенные кадры всех клипов
+proxy_store = ProxyStore()  # Клипы, перекодированные в кадры 640x480 для мгновенного доступа
+WORKERS = max(1, (os.cpu_count() or 1) - 1)  # Процессы для подготовки кадров, 0 - все в окне
+frame_pipeline = None
+tile_compositor = None  # Плитки из разных клипов, если включено в окне
+loaded_videos = queue.Queue()  # Клипы, прочитанные фоновым потоком, ждут добавления в окно
 
 def load_videos():
-    global video_clips
     video_paths = filedialog.askopenfilenames(title="Выберите видео файлы", filetypes=[("Video files", "*.mp4;*.avi;*.mov")])
     if video_paths:
-        for video_path in video_paths:
-            video_clip = VideoFileClip(video_path)
-            video_clips.append((video_path, video_clip))
-            video_listbox.insert(tk.END, video_path)
-
-def shuffle_frame(frame, iterations=6):
-    plitkorez = 2
-    height, width, _ = frame.shape
-    h, w = height // (plitkorez ** iterations), width // (plitkorez ** iterations)
-    
-    tiles = []
-    for i in range(plitkorez ** iterations):
-        for j in range(plitkorez ** iterations):
-            y_start = i * h
-            y_end = (i + 1) * h if (i + 1) * h < height else height
-            x_start = j * w
-            x_end = (j + 1) * w if (j + 1) * w < width else width
-            tiles.append(frame[y_start:y_end, x_start:x_end])
-
-    random.shuffle(tiles)
-
-    reshuffled_frame = []
-    for i in range(plitkorez ** iterations):
-        reshuffled_frame.append(np.hstack(tiles[i * (plitkorez ** iterations):(i + 1) * (plitkorez ** iterations)]))
-
-    return np.vstack(reshuffled_frame)
-
-def blur_frame(frame, blur_strength=41):  # Размываем весь кадр
-    return cv2.GaussianBlur(frame, (blur_strength, blur_strength), 0)
-
-def display_random_frame():
-    if video_clips:
-        video_clip = random.choice(video_clips)[1]
-        start_time = random.uniform(0, video_clip.duration - 1)
-        frame = video_clip.get_frame(start_time)
-        frame_array = np.array(Image.fromarray(frame).resize((640, 480), Image.LANCZOS))
-        
-        # Перемешиваем плитки
-        shuffled_frame = shuffle_frame(frame_array)
-
-        # Применяем размытие
-        blurred_frame = blur_frame(shuffled_frame)
-
-        # Преобразуем в изображение для tkinter
-        blurred_frame_photo = ImageTk.PhotoImage(Image.fromarray(blurred_frame))
-
-        # Отображаем изображение
-        canvas.create_image(0, 0, anchor=tk.NW, image=blurred_frame_photo)
-        canvas.image = blurred_frame_photo
-
-    canvas.after(1000, display_random_frame)
+        # Метаданные читает ffmpeg, для сотен клипов это минуты: в фоне, список в окне пополняется по мере готовности
+        Thread(target=probe_videos, args=(video_paths,), daemon=True).start()
+        root.after(100, show_loaded_videos)
+        if proxy_var.get():
+            proxy_store.ingest(video_paths)  # Заменители готовятся в фоне, пока играет обычный декодер
+
+def probe_videos(video_paths):  # Вызывается в фоновом потоке
+    # Только метаданные, декодер откроется при чтении
+    for video_path, video_clip, error in reader_pool.add_all(video_paths):
+        loaded_videos.put((video_path, video_clip, error))
+    loaded_videos.put(None)
+
+def show_loaded_videos():  # В потоке Tk: клипы, у которых уже прочитаны метаданные
+    failed = []
+    while True:
+        try:
+            loaded = loaded_videos.get_nowait()
+        except queue.Empty:
+            root.after(100, show_loaded_videos)
+            break
+        if loaded is None:
+            break
+        video_path, video_clip, error = loaded
+        if error is not None:
+            failed.append(video_path)
+            continue
+        video_clips.append((video_path, video_clip))
+        frame_sampler.add_clip(video_path, video_clip)  # Индекс ключевых кадров строится в фоне
+        video_listbox.insert(tk.END, video_path)
+    if failed:
+        messagebox.showwarning("Предупреждение", "Не удалось открыть:\n" + "\n".join(failed))
+
+def toggle_proxies():
+    # Заменители занимают место на диске (около 6.6 ГБ на час видео), поэтому только по галочке
+    if proxy_var.get():
+        proxy_store.ingest([video_path for video_path, _ in video_clips])
+
+def next_mosaic_frame():  # Вызывается из потока подготовки кадров
+    if not video_clips:
+        return None
+
+    if frame_pipeline is not None:
+        try:
+            # Слот общей памяти освобождается при следующем get(), а кадр ждет показа в очереди
+            return frame_pipeline.get(timeout=1)[1].copy()
+        except queue.Empty:
+            return None
+
+    if tile_compositor is not None:
+        return blur_frame(tile_compositor.next_frame())
+
+    video_path, video_clip = random.choice(video_clips)
+    frame_array = proxy_store.frame(video_path, random.uniform(0, video_clip.duration - 1))
+    if frame_array is None:
+        start_time = frame_sampler.sample_time(video_path, video_clip)
+        frame_array = frame_cache.fetch(video_path, video_clip.fps, start_time,
+                                        lambda t: frame_sampler.get_frame(video_path, video_clip, t))
+
+    # Перемешиваем плитки
+    shuffled_frame = shuffle_frame(frame_array)
+
+    # Применяем размытие
+    return blur_frame(shuffled_frame)
+
+def show_audio_progress(audio_extractor):
+    done, total = audio_extractor.progress()
+    if done < total:
+        root.title("Генератор случайного видео (звук %d/%d)" % (done, total))
+        root.after(200, show_audio_progress, audio_extractor)
+    else:
+        root.title("Генератор случайного видео")
 
 def start_video():
-    global video_clips
+    global video_clips, frame_pipeline, tile_compositor
     if not video_clips:
         messagebox.showwarning("Предупреждение", "Выберите видео файлы сначала.")
         return
-        
-    audio_segments = []
-    for video_path, video_clip in video_clips:
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio_file:
-            audio_path = temp_audio_file.name
-            video_clip.audio.write_audiofile(audio_path)
-            audio_segment = AudioSegment.from_file(audio_path)
 
-            audio_segments.append(audio_segment)
+    if WORKERS and frame_pipeline is None:
+        # Кадры готовят отдельные процессы, окно только показывает их; метаданные клипов они получают готовыми
+        frame_pipeline = FramePipeline([video_path for video_path, _ in video_clips], WORKERS, proxies=proxy_var.get(),
+                                       composite=composite_var.get(),
+                                       clip_infos={video_path: video_clip.infos for video_path, video_clip in video_clips})
+    elif not WORKERS and composite_var.get() and tile_compositor is None:
+        # Каждый клип декодирует один кадр, который отдает плитки сразу во много мест
+        tile_compositor = TileCompositor(video_clips, frame_sampler, frame_cache, proxy_store=proxy_store)
+
+    # Звук всех клипов извлекается параллельно, играть начинаем, как только готов первый
+    audio_extractor = extract_audio(audio_mosaic, [(video_path, video_clip.audio_duration)
+                                                   for video_path, video_clip in video_clips
+                                                   if video_clip.audio_duration is not None], cache=pcm_cache)
+    show_audio_progress(audio_extractor)
+    Thread(target=audio_mosaic.play_audio, daemon=True).start()  
+    frame_scheduler.start()  
+
+if __name__ == "__main__":  # На Windows процессы-обработчики импортируют этот файл заново
+    # Создание графического интерфейса
+    root = tk.Tk()
+    root.title("Генератор случайного видео")
 
-        os.remove(audio_path)  # Удаляем файл после использования
+    canvas = tk.Canvas(root, width=640, height=480)
+    canvas.pack()
+    frame_display = CanvasDisplay(canvas)  # Одно изображение на холсте, обновляется на месте
+    frame_scheduler = FrameScheduler(canvas, next_mosaic_frame, frame_display.show, fps=FPS)  # Показ по сроку, кадры готовятся заранее
 
-    combined_audio = sum(audio_segments)
-    audio_mosaic.convert_audio_to_segments(combined_audio)
-    Thread(target=audio_mosaic.play_audio, daemon=True).start()  
-    display_random_frame()  
+    video_listbox = tk.Listbox(root, width=80, height=10)
+    video_listbox.pack()
+
+    select_button = tk.Button(root, text="Выбрать видео", command=load_videos)
+    select_button.pack()
 
-# Создание графического интерфейса
-root = tk.Tk()
-root.title("Генератор случайного видео")
+    start_button = tk.Button(root, text="Старт видео", command=start_video)
+    start_button.pack()
 
-canvas = tk.Canvas(root, width=640, height=480)
-canvas.pack()
+    composite_var = tk.BooleanVar(value=False)
+    composite_check = tk.Checkbutton(root, text="Плитки из разных клипов", variable=composite_var)
+    composite_check.pack()
 
-video_listbox = tk.Listbox(root, width=80, height=10)
-video_listbox.pack()
+    proxy_var = tk.BooleanVar(value=False)
+    proxy_check = tk.Checkbutton(root, text="Заменители клипов на диске (быстрый случайный доступ)",
+                                 variable=proxy_var, command=toggle_proxies)
+    proxy_check.pack()
 
-select_button = tk.Button(root, text="Выбрать видео", command=load_videos)
-select_button.pack()
+    layers_scale = tk.Scale(root, from_=1, to=16, orient=tk.HORIZONTAL, label="Слои звука",
+                            command=lambda value: audio_mosaic.set_layers(int(value)))  # Применяется за один блок
+    layers_scale.pack()
 
-start_button = tk.Button(root, text="Старт видео", command=start_video)
-start_button.pack()
+    window_shown(root)  # Время до появления окна попадает в замеры (startup_window)
+    preload()  # moviepy, OpenCV и pygame грузятся в фоне, пока окно уже на экране
+    start_metrics()  # Замеры этапов: http://127.0.0.1:9464/metrics, журнал и профилировщик - см. README
 
-# Запустить основной цикл интерфейса
-root.mainloop()
+    # Запустить основной цикл интерфейса
+    root.mainloop()
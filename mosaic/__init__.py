@@ -0,0 +1 @@
+# Общие модули генератора случайной видео-мозаики
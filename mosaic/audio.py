@@ -0,0 +1,468 @@
+import math
+import subprocess
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mosaic.metrics import metrics
+
+
+CHUNK_SECONDS = 1  # Сколько перемешанного звука собираем за раз для записи в файл
+BLOCK_MS = 40  # Блок, который за раз уходит в микшер: стоп и смена параметров слышны не позже чем через блок
+CROSSFADE_MS = 10  # Перекрытие на стыке сегментов, чтобы не было щелчков
+MIXER_BUFFER = 512  # Кадров в буфере звуковой карты (11.6 мс при 44100)
+SAMPLE_RATE = 44100
+CHANNELS = 2
+MAX_LAYERS = 32  # Запас int32: 32 слоя * 32767 * (1 << WEIGHT_BITS) < 2 ** 31
+WEIGHT_BITS = 10  # Громкость и панорама слоя при сведении - целые в долях 1/1024
+LIMIT_RELEASE = 0.2  # Какую часть пути к полной громкости ограничитель проходит за блок
+
+
+def layer_weights(layers, channels, gain=1.0):
+    # Веса слоев по каналам в долях 1 << WEIGHT_BITS. Панорама - баланс: в центре оба канала
+    # с полной громкостью, при pan=1 левый канал молчит
+    # Громкость не выше 1: иначе сумма слоев может переполнить int32 (см. MAX_LAYERS)
+    gains = np.clip(np.array([layer_gain for layer_gain, _ in layers], dtype=np.float32)[:, None] * gain, 0, 1)
+    pans = np.clip(np.array([pan for _, pan in layers], dtype=np.float32), -1, 1)
+    if channels == 2:
+        balance = np.stack([np.minimum(1, 1 - pans), np.minimum(1, 1 + pans)], axis=1)
+    else:
+        balance = np.ones((len(layers), channels), dtype=np.float32)
+    return np.rint(gains * balance * (1 << WEIGHT_BITS)).astype(np.int32)
+
+
+class SegmentStream:
+    # Бесконечный поток перемешанных сегментов блоками по block_frames кадров.
+    # На стыке начало нового сегмента смешивается с продолжением прошлого (тем, что в исходном звуке
+    # шло после его конца): длительность не меняется, а волна не обрывается.
+    # Перемешивание заново (reshuffle) и громкость применяются со следующего блока.
+    # apply_gain=False - громкость применяет LayerMixer вместе с весами слоев
+    def __init__(self, mosaic, block_frames, fade_frames, apply_gain=True):
+        self.mosaic = mosaic
+        self.apply_gain = apply_gain
+        self.block_frames = block_frames
+        self.fade_frames = fade_frames
+        # Нарастание нового сегмента; убывание прошлого - 1 - ramp
+        self.ramp = ((np.arange(fade_frames, dtype=np.float32) + 0.5) / max(1, fade_frames))[:, None]
+        self.order = np.zeros(0, dtype=np.int64)
+        self.next_index = 0
+        self.segment = np.zeros((0, mosaic.channels), dtype=np.int16)
+        self.position = 0
+        self.current = None  # (источник, начало) звучащего сегмента
+        self.previous = None  # (источник, кадр), откуда продолжился бы прошлый сегмент
+        self.version = mosaic.version
+        self.gain = mosaic.gain
+        self.changed_at = None  # Когда была команда, которую несет последний блок
+
+    def _next_segment(self, sources, offsets):
+        if self.next_index >= len(self.order):
+            self.order = np.random.permutation(len(offsets))
+            self.next_index = 0
+        source, begin, length = offsets[self.order[self.next_index]]
+        self.next_index += 1
+        segment = sources[source][begin:begin + length]
+        fade = min(self.fade_frames, len(segment))
+        if fade:
+            # Продолжение прошлого сегмента; в начале и после конца источника - тишина
+            tail = np.zeros((fade, segment.shape[1]), dtype=np.float32)
+            if self.previous is not None:
+                previous_source, previous_end = self.previous
+                continuation = sources[previous_source][previous_end:previous_end + fade]
+                tail[:len(continuation)] = continuation
+            ramp = self.ramp[:fade]
+            segment = segment.copy()
+            segment[:fade] = np.rint(segment[:fade] * ramp + tail * (1 - ramp))
+        self.segment = segment
+        self.position = 0
+        self.current = (source, begin)
+        self.previous = (source, begin + length)
+
+    def next_block(self, out=None):
+        # None - звука еще нет; out - куда собрать блок (block_frames x каналы, int16)
+        mosaic = self.mosaic
+        with mosaic.lock:
+            sources, offsets = mosaic.sources, mosaic.offsets
+            version, gain = mosaic.version, mosaic.gain
+            changed_at, mosaic.changed_at = mosaic.changed_at, None
+        if not len(offsets):
+            return None
+        self.changed_at = changed_at
+        if version != self.version:
+            # Новый порядок начинается прямо с этого блока, с переходом от того места, где играли
+            self.version = version
+            self.order = np.zeros(0, dtype=np.int64)
+            if self.current is not None and self.current[0] < len(sources):
+                self.previous = (self.current[0], self.current[1] + self.position)
+            else:
+                self.previous = None
+            self.segment = self.segment[:0]
+
+        block = out if out is not None else np.empty((self.block_frames, mosaic.channels), dtype=np.int16)
+        filled = 0
+        while filled < self.block_frames:
+            if self.position >= len(self.segment):
+                self._next_segment(sources, offsets)
+            take = min(self.block_frames - filled, len(self.segment) - self.position)
+            block[filled:filled + take] = self.segment[self.position:self.position + take]
+            self.position += take
+            filled += take
+
+        if self.apply_gain and (gain != 1.0 or self.gain != 1.0):
+            # Громкость плавно переходит к новой за один блок
+            gains = np.linspace(self.gain, gain, self.block_frames, dtype=np.float32)[:, None]
+            block = np.clip(np.rint(block * gains), -32768, 32767).astype(np.int16)
+            self.gain = gain
+        return block
+
+
+class LayerMixer:
+    # Несколько независимых потоков сегментов (слоев) сводятся в один. У каждого слоя свой порядок
+    # сегментов из всех клипов, своя громкость и панорама. Сведение - одно умножение и сумма в int32
+    # над блоками всех слоев сразу, затем ограничитель и обратно в int16. Новые веса (громкость,
+    # панорама, число слоев) плавно наступают за один блок, убранный слой за этот блок затихает.
+    def __init__(self, mosaic, block_frames, fade_frames):
+        self.mosaic = mosaic
+        self.block_frames = block_frames
+        self.fade_frames = fade_frames
+        self.streams = []
+        self.weights = np.zeros((0, mosaic.channels), dtype=np.int32)
+        self.config = None
+        self.target = self.weights
+        self.blocks = np.empty((0, block_frames, mosaic.channels), dtype=np.int16)
+        self.ramp = (np.arange(block_frames, dtype=np.float32) / block_frames)[None, :, None]
+        self.limit = 1.0
+        self.cpu = np.zeros(0)  # Секунды процессора на слой за последний блок, сведение - поровну
+        self.changed_at = None
+
+    def next_block(self):
+        mosaic = self.mosaic
+        with mosaic.lock:
+            config = (mosaic.layers, mosaic.gain)
+        if config != self.config:
+            self.config = config
+            self.target = layer_weights(config[0], mosaic.channels, config[1])
+        count = max(len(self.streams), len(self.target))
+        while len(self.streams) < count:
+            # Новый слой начинается с нарастания из тишины (перехода от "ничего")
+            self.streams.append(SegmentStream(mosaic, self.block_frames, self.fade_frames, apply_gain=False))
+        if len(self.blocks) < count:
+            self.blocks = np.empty((count, self.block_frames, mosaic.channels), dtype=np.int16)
+
+        cpu = np.zeros(count)
+        self.changed_at = None
+        for number, stream in enumerate(self.streams):
+            start = time.thread_time()
+            if stream.next_block(self.blocks[number]) is None:
+                return None  # Звук еще извлекается
+            cpu[number] = time.thread_time() - start
+            self.changed_at = self.changed_at or stream.changed_at
+
+        start = time.thread_time()
+        weights = np.zeros((count, mosaic.channels), dtype=np.int32)
+        weights[:len(self.weights)] = self.weights
+        target = np.zeros_like(weights)
+        target[:len(self.target)] = self.target
+        blocks = self.blocks[:count]
+        if count == 1 and self.limit == 1.0 and (target == 1 << WEIGHT_BITS).all() and np.array_equal(weights, target):
+            # Один слой без изменений громкости: сводить нечего
+            block = blocks[0].copy()
+        else:
+            if np.array_equal(weights, target):
+                mix = (blocks * target[:, None, :]).sum(axis=0, dtype=np.int32)
+            else:
+                ramped = weights[:, None, :] + ((target - weights)[:, None, :] * self.ramp).astype(np.int32)
+                mix = (blocks * ramped).sum(axis=0, dtype=np.int32)
+            mix >>= WEIGHT_BITS
+            block = self._limit(mix)
+        cpu += (time.thread_time() - start) / count
+
+        # Убранные слои уже затихли в этом блоке
+        del self.streams[len(self.target):]
+        self.weights = self.target
+        self.cpu = cpu[:len(self.target)]
+        return block
+
+    def _limit(self, mix):
+        # Ограничитель по блокам: если сумма слоев выходит за int16, громкость блока сразу снижается
+        # до безопасной, а потом за несколько блоков возвращается к полной
+        peak = int(np.abs(mix).max()) if len(mix) else 0
+        target = min(1.0, 32768 / peak) if peak else 1.0
+        if target < 1.0:
+            metrics.count("audio_limited")
+        if target < self.limit:
+            limit = target
+            mix = np.rint(mix * np.float32(limit))
+        else:
+            limit = self.limit + (target - self.limit) * LIMIT_RELEASE
+            if limit > 0.999:
+                limit = 1.0
+            if limit < 1.0 or self.limit < 1.0:
+                mix = np.rint(mix * np.linspace(self.limit, limit, len(mix), dtype=np.float32)[:, None])
+        self.limit = limit
+        return np.clip(mix, -32768, 32767).astype(np.int16)
+
+
+class AudioMosaic:
+    def __init__(self):
+        # Звук каждого клипа - массив int16 (кадры x каналы): вид на общий буфер или np.memmap из кэша.
+        # Сегменты - только таблица (источник, начало, длина), сам звук не копируется.
+        self.sources = []
+        self.offsets = np.zeros((0, 3), dtype=np.int64)
+        self.segment_frames = 0
+        self.sample_rate = 0
+        self.channels = CHANNELS
+        self.sample_width = 2
+        self.is_playing = False
+        self.mixer_ready = False
+        self.version = 0  # Растет при reset и reshuffle: играющий поток начинает новый порядок
+        self.gain = 1.0
+        self.layers = ((1.0, 0.0),)  # (громкость, панорама) каждого слоя
+        self.mixer = None
+        self.changed_at = None
+        self.blocks = 0
+        self.underruns = 0
+        self.lock = threading.Lock()
+        metrics.gauge("audio_layers", lambda: len(self.layers))
+        metrics.gauge("audio_cpu_per_layer", lambda: float(np.mean(self.layer_load() or [0.0])))
+
+    def init_mixer(self):
+        # Звуковое устройство нужно только для воспроизведения, не для записи в файл.
+        # pygame тоже импортируется только здесь
+        if not self.mixer_ready:
+            import pygame
+
+            pygame.mixer.init(frequency=self.sample_rate or SAMPLE_RATE, size=-16, channels=self.channels,
+                              buffer=MIXER_BUFFER)
+            self.mixer_ready = True
+
+    def convert_audio_to_segments(self, audio, segment_duration_ms=500):
+        if audio.sample_width != 2:
+            audio = audio.set_sample_width(2)
+        # frombuffer не копирует raw_data
+        pcm = np.frombuffer(audio.raw_data, dtype=np.int16).reshape(-1, audio.channels)
+        self.reset(audio.frame_rate, audio.channels, segment_duration_ms)
+        self.add_pcm(pcm)
+
+    def reset(self, sample_rate, channels=CHANNELS, segment_duration_ms=500):
+        with self.lock:
+            self.sources = []
+            self.offsets = np.zeros((0, 3), dtype=np.int64)
+            self.sample_rate = sample_rate
+            self.channels = channels
+            self.segment_frames = max(1, sample_rate * segment_duration_ms // 1000)
+            self.version += 1
+
+    def reshuffle(self):
+        # Новый порядок сегментов со следующего блока, а не с конца круга
+        with self.lock:
+            self.version += 1
+            self.changed_at = time.perf_counter()
+
+    def set_gain(self, gain):
+        with self.lock:
+            self.gain = min(max(float(gain), 0.0), 1.0)  # Громче исходного не бывает, см. layer_weights
+            self.changed_at = time.perf_counter()
+
+    def set_layers(self, count, gains=None, pans=None):
+        # count одновременно звучащих слоев. По умолчанию громкость слоя 1 / sqrt(count) - сумма
+        # несвязанных слоев примерно так же громка, как один, - и панорама поровну от -0.8 до 0.8
+        count = int(count)
+        if not 1 <= count <= MAX_LAYERS:
+            raise ValueError("Слоев должно быть от 1 до %d, а не %d" % (MAX_LAYERS, count))
+        if gains is None:
+            gains = [1 / math.sqrt(count)] * count
+        if pans is None:
+            pans = np.linspace(-0.8, 0.8, count) if count > 1 else [0.0]
+        if len(gains) != count or len(pans) != count:
+            raise ValueError("Громкостей и панорам должно быть по одной на слой")
+        with self.lock:
+            self.layers = tuple((min(max(float(gain), 0.0), 1.0), float(pan)) for gain, pan in zip(gains, pans))
+            self.changed_at = time.perf_counter()
+
+    def add_pcm(self, pcm):
+        # Можно вызывать из рабочих потоков, пока звук уже играет
+        starts = np.arange(0, len(pcm), self.segment_frames, dtype=np.int64)
+        with self.lock:
+            table = np.empty((len(starts), 3), dtype=np.int64)
+            table[:, 0] = len(self.sources)
+            table[:, 1] = starts
+            table[:, 2] = np.minimum(len(pcm) - starts, self.segment_frames)
+            self.sources = self.sources + [pcm]
+            self.offsets = np.concatenate([self.offsets, table])
+
+    def stream(self, block_ms=BLOCK_MS, crossfade_ms=CROSSFADE_MS):
+        sample_rate = self.sample_rate or SAMPLE_RATE
+        return LayerMixer(self, max(1, sample_rate * block_ms // 1000), sample_rate * crossfade_ms // 1000)
+
+    def play_audio(self):
+        # В канале микшера не больше двух блоков: один играет, второй ждет. Следующий блок собирается,
+        # только когда освободилось место, поэтому стоп и новые параметры слышны через блок.
+        self.init_mixer()
+        import pygame
+
+        self.is_playing = True
+        stream = self.mixer = self.stream()
+        block_seconds = stream.block_frames / (self.sample_rate or SAMPLE_RATE)
+        buffer_seconds = MIXER_BUFFER / (self.sample_rate or SAMPLE_RATE)
+        channel = pygame.mixer.Channel(0)
+        queued = None  # (время сборки, время команды) блока, ждущего в очереди канала
+        while self.is_playing:
+            while self.is_playing and channel.get_busy() and channel.get_queue() is not None:
+                time.sleep(block_seconds / 8)
+            if not self.is_playing:
+                break
+            if queued is not None:
+                # Блок из очереди только что начал играть
+                self._record_latency(queued, buffer_seconds)
+                queued = None
+
+            with metrics.timed("audio_block"):
+                block = stream.next_block()
+            if block is None:
+                time.sleep(block_seconds)  # Звук еще извлекается
+                continue
+            made = (time.perf_counter(), stream.changed_at)
+            sound = pygame.mixer.Sound(buffer=block)
+            self.blocks += 1
+            if not channel.get_busy():
+                if self.blocks > 1:
+                    self.underruns += 1
+                    metrics.count("audio_underruns")  # Очередь канала опустела раньше, чем пришел блок
+                channel.play(sound)
+                self._record_latency(made, buffer_seconds)
+            else:
+                channel.queue(sound)
+                queued = made
+
+    def _record_latency(self, made, buffer_seconds):
+        # От сборки блока (или от команды, которую он несет) до выхода из звуковой карты
+        now = time.perf_counter() + buffer_seconds
+        made_at, changed_at = made
+        metrics.observe("audio_latency", now - made_at)
+        if changed_at is not None:
+            metrics.observe("audio_control_latency", now - changed_at)
+
+    def stop_audio(self):
+        self.is_playing = False
+        if self.mixer_ready:
+            import pygame
+
+            pygame.mixer.fadeout(BLOCK_MS)  # Затихает за один блок, без щелчка
+
+    def layer_load(self):
+        # Доля одного ядра на каждый слой: время процессора на блок к длительности блока
+        mixer = self.mixer
+        if mixer is None:
+            return []
+        block_seconds = mixer.block_frames / (self.sample_rate or SAMPLE_RATE)
+        return [float(cpu / block_seconds) for cpu in mixer.cpu]
+
+    def stats(self):
+        latency = metrics.histogram("audio_latency").snapshot()
+        return {
+            "blocks": self.blocks,
+            "underruns": self.underruns,
+            "block_ms": BLOCK_MS,
+            "latency_p50_ms": latency["p50_ms"],
+            "latency_max_ms": latency["max_ms"],
+            "layers": len(self.layers),
+            "cpu_per_layer": self.layer_load(),
+        }
+
+    def write_wav(self, path, duration):
+        # Пишем перемешанное аудио нужной длительности, перемешивая заново по кругу
+        remaining = int(duration * self.sample_rate)
+        with wave.open(path, "wb") as wav_file:
+            wav_file.setnchannels(self.channels)
+            wav_file.setsampwidth(self.sample_width)
+            wav_file.setframerate(self.sample_rate)
+            # Те же переходы на стыках, что и при воспроизведении, только крупными блоками
+            stream = self.stream(CHUNK_SECONDS * 1000)
+            while remaining > 0 and len(self.offsets):
+                chunk = stream.next_block()[:remaining]
+                wav_file.writeframes(chunk.tobytes())
+                remaining -= len(chunk)
+
+
+def decode_audio(path, out, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    # ffmpeg сразу отдает PCM в канал, читаем его прямо в срез общего буфера без временных файлов
+    from moviepy.config import get_setting
+
+    cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-i", path, "-vn",
+           "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(sample_rate), "-ac", str(channels), "-"]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+    target = memoryview(out).cast("B")
+    filled = 0
+    try:
+        while filled < len(target):
+            count = process.stdout.readinto(target[filled:])
+            if not count:
+                break
+            filled += count
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+    return filled // (2 * channels)
+
+
+class AudioExtractor:
+    # Извлекает звук всех клипов параллельно. Клипы из кэша открываются через np.memmap,
+    # остальные декодируются в один заранее выделенный буфер и сохраняются в кэш.
+    # Кэш проверяется в рабочих потоках: ключ читает по 2 МБ каждого файла, а конструктор
+    # вызывается из потока Tk. clips - список (путь, длительность звука в секундах)
+    def __init__(self, clips, sample_rate=SAMPLE_RATE, channels=CHANNELS, workers=4, cache=None):
+        self.paths = [path for path, _ in clips]
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.workers = workers
+        self.cache = cache
+        # Запас в одну секунду на неточность длительности из метаданных. Место есть и у клипов из кэша:
+        # np.zeros получает страницы от системы только при записи, так что нетронутое память не занимает
+        sizes = [int(math.ceil(duration * sample_rate)) + sample_rate for _, duration in clips]
+        self.starts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.pcm = np.zeros((int(self.starts[-1]), channels), dtype=np.int16)
+        self.done = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def _extract(self, index, on_ready):
+        start_time = time.perf_counter()
+        pcm = self.cache.load(self.paths[index], self.sample_rate, self.channels) if self.cache else None
+        if pcm is None:
+            start, end = self.starts[index], self.starts[index + 1]
+            frames = decode_audio(self.paths[index], self.pcm[start:end], self.sample_rate, self.channels)
+            pcm = self.pcm[start:start + frames]
+            if self.cache is not None and frames:
+                self.cache.store(self.paths[index], pcm, self.sample_rate, self.channels)
+        metrics.observe("audio_extract", time.perf_counter() - start_time)
+        with self.lock:
+            self.done += 1
+        if on_ready is not None and len(pcm):
+            on_ready(pcm)
+
+    def start(self, on_ready=None):
+        # on_ready(pcm) вызывается из рабочего потока, как только готов звук очередного клипа
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [self.executor.submit(self._extract, index, on_ready) for index in range(len(self.paths))]
+        self.executor.shutdown(wait=False)
+        return futures
+
+    def progress(self):
+        with self.lock:
+            return self.done, len(self.paths)
+
+    def wait(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+def extract_audio(audio_mosaic, clips, workers=4, cache=None):
+    # Готовит AudioMosaic; воспроизведение можно запускать сразу, сегменты добавляются по мере готовности
+    extractor = AudioExtractor(clips, workers=workers, cache=cache)
+    audio_mosaic.reset(extractor.sample_rate, extractor.channels)
+    extractor.start(audio_mosaic.add_pcm)
+    return extractor
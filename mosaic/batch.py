@@ -0,0 +1,196 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mosaic.blur import blur_engine, blur_frame
+from mosaic.frames import OUTPUT_SIZE
+from mosaic.metrics import metrics
+from mosaic.proxy import ProxyStore
+from mosaic.render import MosaicRenderer, odd_kernel
+from mosaic.tiles import PLITKOREZ, PermutationPool, grid_size
+
+OUTPUT_NAME = "mosaic-%03d-seed%d.mp4"
+WRITE_WORKERS = 8  # Потоки, которые размывают и отдают кадры вариантов кодировщикам
+
+
+class Variant:
+    # Один выходной файл: свое зерно перестановок, своя сетка и свое размытие
+    def __init__(self, path, seed, iterations=6, blur_strength=41):
+        self.path = path
+        self.seed = seed
+        self.iterations = iterations
+        self.blur_strength = blur_strength
+        self.pool = PermutationPool(seed=seed)
+        self.writer = None
+
+
+class BatchShuffler:
+    # Плитки одного общего кадра для всех вариантов сразу. Варианты с одинаковой сеткой
+    # собираются одной выборкой по виду (плитка строк, h, плитка столбцов, w), как в TileCompositor:
+    # без индекса на пиксель, поэтому память не растет с числом вариантов и зерен.
+    def __init__(self, variants, size=OUTPUT_SIZE):
+        self.size = size
+        width, height = size
+        groups = {}
+        for number, variant in enumerate(variants):
+            groups.setdefault(variant.iterations, []).append(number)
+        self.groups = [(iterations, numbers, np.empty((len(numbers), height, width, 3), dtype=np.uint8))
+                       for iterations, numbers in groups.items()]
+        self.variants = variants
+
+    def shuffle(self, frame):
+        # Список кадров вариантов в порядке variants: виды на общий буфер, перезаписываются следующим вызовом
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        height, width, channels = frame.shape
+        frames = [None] * len(self.variants)
+        for iterations, numbers, out in self.groups:
+            rows, cols = grid_size(height, width, iterations)
+            levels = iterations if rows == cols == PLITKOREZ ** iterations else None
+            orders = np.stack([np.asarray(self.variants[number].pool.table(rows, cols, levels)[1], dtype=np.intp)
+                               for number in numbers])
+            src_row, src_col = np.divmod(orders.reshape(len(numbers), rows, cols), cols)
+            h, w = height // rows, width // cols
+            tiles = frame[:rows * h, :cols * w].reshape(rows, h, cols, w, channels)
+            out_tiles = out[:, :rows * h, :cols * w].reshape(len(numbers), rows, h, cols, w, channels)
+            out_tiles[...] = tiles[src_row, :, src_col].transpose(0, 1, 3, 2, 4, 5)
+            # Остаток снизу и справа (480 // 64 = 7, 7 * 64 = 448) остается на месте
+            out[:, rows * h:] = frame[rows * h:]
+            out[:, :, cols * w:] = frame[:, cols * w:]
+            for index, number in enumerate(numbers):
+                frames[number] = out[index]
+        return frames
+
+
+def _emit(variant, frame):
+    if variant.blur_strength:
+        frame = blur_frame(frame, variant.blur_strength)
+    variant.writer.write_frame(frame)
+
+
+def make_variants(output_dir, count, seed=0, iterations=(6,), blur_strengths=(41,)):
+    # Зерна seed, seed + 1, ...; сетки и ядра размытия чередуются по кругу
+    return [Variant(os.path.join(output_dir, OUTPUT_NAME % (number, seed + number)), seed + number,
+                    iterations[number % len(iterations)], blur_strengths[number % len(blur_strengths)])
+            for number in range(count)]
+
+
+def render_batch(clip_paths, variants, duration=60, fps=25, seed=None, with_audio=True, codec="libx264",
+                 preset="veryfast", proxies=False, workers=WRITE_WORKERS):
+    # Каждый кадр источника декодируется и уменьшается один раз и расходится во все варианты.
+    # Выбор клипов и моментов общий (seed), у вариантов свои перестановки, сетки, размытие и звук
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+    random.seed(seed)
+    np.random.seed(seed)
+    blur_engine.set_stable(seed is not None)
+
+    proxy_store = None
+    if proxies:
+        proxy_store = ProxyStore()
+        for future in proxy_store.ingest(clip_paths):
+            future.result()
+
+    renderer = MosaicRenderer(clip_paths, proxy_store=proxy_store)
+    renderer.sampler.wait()
+    shuffler = BatchShuffler(variants, renderer.size)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(variants))))
+    audio_paths = []
+    decode_seconds = 0.0
+    try:
+        audio_mosaic = renderer.audio_mosaic() if with_audio else None
+        for variant in variants:
+            audio_path = None
+            if audio_mosaic is not None:
+                # Звук извлекается один раз, у каждого варианта свой порядок сегментов
+                np.random.seed(variant.seed)
+                with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio_file:
+                    audio_path = temp_audio_file.name
+                audio_paths.append(audio_path)
+                audio_mosaic.write_wav(audio_path, duration)
+            variant.writer = FFMPEG_VideoWriter(variant.path, renderer.size, fps, codec=codec,
+                                                audiofile=audio_path, preset=preset)
+
+        frame_count = int(round(duration * fps))
+        start = time.perf_counter()
+        pending = []
+        for _ in range(frame_count):
+            decode_start = time.perf_counter()
+            frame_array = renderer.next_source()
+            decode_seconds += time.perf_counter() - decode_start
+            # Пока декодировался этот кадр, прошлый размывался и писался; буфер плиток общий - ждем его
+            for future in pending:
+                future.result()
+            with metrics.timed("batch_shuffle"):
+                frames = shuffler.shuffle(frame_array)
+            pending = [executor.submit(_emit, variant, frame) for variant, frame in zip(variants, frames)]
+        for future in pending:
+            future.result()
+        elapsed = time.perf_counter() - start
+    finally:
+        executor.shutdown(wait=True)
+        for variant in variants:
+            if variant.writer is not None:
+                variant.writer.close()
+                variant.writer = None
+        renderer.close()
+        for audio_path in audio_paths:
+            os.remove(audio_path)
+
+    return {
+        "variants": len(variants),
+        "frames": frame_count,
+        "seconds": elapsed,
+        "decode_seconds": decode_seconds,
+        "fps": frame_count * len(variants) / elapsed if elapsed else 0.0,
+        "per_variant_ms": (elapsed - decode_seconds) / frame_count / len(variants) * 1000 if frame_count else 0.0,
+        "paths": [variant.path for variant in variants],
+        "readers": renderer.readers.stats(),
+    }
+
+
+def int_list(value):
+    return tuple(int(part) for part in value.split(",") if part.strip())
+
+
+def kernel_list(value):
+    return tuple(odd_kernel(part) for part in value.split(",") if part.strip())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Много вариантов мозаики с разными зернами за один проход декодирования")
+    parser.add_argument("clips", nargs="+", help="исходные видео файлы")
+    parser.add_argument("-o", "--output-dir", default="mosaics")
+    parser.add_argument("-n", "--variants", type=int, default=8, help="сколько файлов записать")
+    parser.add_argument("--duration", type=float, default=60.0, help="длительность в секундах")
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--iterations", type=int_list, default=(6,),
+                        help="итерации плиткорезки через запятую, чередуются по вариантам")
+    parser.add_argument("--blur", type=kernel_list, default=(41,),
+                        help="ядра размытия через запятую, чередуются по вариантам")
+    parser.add_argument("--seed", type=int, default=0, help="зерно первого варианта и выбора кадров")
+    parser.add_argument("--no-audio", action="store_true")
+    parser.add_argument("--proxy", action="store_true",
+                        help="сначала перекодировать клипы в заменители для быстрого случайного доступа")
+    parser.add_argument("--workers", type=int, default=WRITE_WORKERS,
+                        help="потоки, которые размывают кадры и отдают их кодировщикам")
+    args = parser.parse_args(argv)
+    if args.variants < 1 or not args.iterations or not args.blur:
+        parser.error("нужен хотя бы один вариант, одна сетка и одно ядро")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    variants = make_variants(args.output_dir, args.variants, args.seed, args.iterations, args.blur)
+    report = render_batch(args.clips, variants, args.duration, args.fps, args.seed, not args.no_audio,
+                          proxies=args.proxy, workers=args.workers)
+    print("Вариантов: %d по %d кадров за %.2f с, %.1f кадр/с на все варианты" % (
+        report["variants"], report["frames"], report["seconds"], report["fps"]))
+    print("Декод: %.2f с на все варианты сразу, остальное - %.2f мс на кадр варианта" % (
+        report["decode_seconds"], report["per_variant_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from moviepy.config import get_setting
+
+from mosaic.audio import BLOCK_MS, AudioMosaic, extract_audio
+from mosaic.batch import make_variants, render_batch
+from mosaic.blur import BACKENDS, blur_engine
+from mosaic.pcm_cache import PcmCache
+from mosaic.proxy import ProxyStore
+from mosaic.render import MosaicRenderer, render
+from mosaic.startup import IMPORT_TARGET
+from mosaic.tiles import permutation_pool, shuffle_frame
+
+RESOLUTIONS = {"480p": (640, 480), "1080p": (1920, 1080), "4k": (3840, 2160)}
+ITERATIONS = range(1, 8)
+KERNELS = (11, 21, 41, 81)
+CLIP_COUNTS = (1, 4, 8)
+COMPOSITE_CLIPS = (16, 32)  # Источников у мозаики, где каждая плитка из своего клипа
+AUDIO_SECONDS = (10, 60, 300)
+AUDIO_LAYERS = (1, 4, 16, 32)  # Одновременно звучащих слоев при сведении
+BATCH_VARIANTS = (1, 4, 16)  # Вариантов с разными зернами за один проход декодирования
+CLIP_SECONDS = 20
+CLIP_FPS = 25
+REFERENCE_CLIPS = 4  # На скольких клипах 480p считаются итоговые кадр/с и запуск звука
+E2E_SECONDS = 10  # Длительность записи для итоговых кадр/с
+RUNS = 20
+TOLERANCE = 0.15  # Насколько можно быть медленнее эталона, прежде чем считать это регрессией
+
+QUICK = {
+    "resolutions": ("480p",),
+    "iterations": (1, 4, 7),
+    "kernels": (21, 41),
+    "clip_counts": (1, 4),
+    "composite_clips": (16,),
+    "audio_seconds": (10,),
+    "audio_layers": (1, 16),
+    "batch_variants": (1, 4),
+    "runs": 5,
+}
+
+STAGES = ("import", "shuffle", "blur", "fetch", "composite", "audio", "startup", "e2e", "batch")
+HIGHER_IS_BETTER = {"end_to_end_fps"}
+
+
+def make_video(path, seconds, size, index=0):
+    # Синтетический клип: движущаяся тестовая таблица и тон, ключевой кадр каждые 2 секунды
+    if os.path.exists(path):
+        return path
+    width, height = size
+    cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-y",
+           "-f", "lavfi", "-i", "testsrc2=size=%dx%d:rate=%d:duration=%s" % (width, height, CLIP_FPS, seconds),
+           "-f", "lavfi", "-i", "sine=frequency=%d:duration=%s" % (220 + 110 * index, seconds),
+           "-vf", "hue=h=%d" % (37 * index), "-c:v", "libx264", "-preset", "ultrafast",
+           "-g", str(CLIP_FPS * 2), "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path + ".tmp.mp4"]
+    subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL)
+    os.replace(path + ".tmp.mp4", path)
+    return path
+
+
+def make_audio(path, seconds):
+    if os.path.exists(path):
+        return path
+    cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-y",
+           "-f", "lavfi", "-i", "anoisesrc=color=pink:seed=1:duration=%s" % seconds,
+           "-ar", "44100", "-ac", "2", path + ".tmp.wav"]
+    subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL)
+    os.replace(path + ".tmp.wav", path)
+    return path
+
+
+def make_clips(media_dir, count, resolution):
+    size = RESOLUTIONS[resolution]
+    return [make_video(os.path.join(media_dir, "clip-%s-%d.mp4" % (resolution, index)), CLIP_SECONDS, size, index)
+            for index in range(count)]
+
+
+def measure(fn, runs=RUNS, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"median_ms": statistics.median(times) * 1000, "min_ms": min(times) * 1000, "runs": runs}
+
+
+def import_time(module, runs):
+    # Каждый раз в новом процессе, иначе модули уже загружены; время самого интерпретатора не входит
+    code = "import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)" % module
+    times = [float(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                  cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout)
+             for _ in range(runs)]
+    return {"median_ms": statistics.median(times) * 1000, "min_ms": min(times) * 1000, "runs": runs}
+
+
+def bench_import(runs):
+    # mosaic.render - путь записи без окна; остальное - то, что нужно окну до первого кадра
+    return {
+        "import/mosaic.render": import_time("mosaic.render", runs),
+        "import/window": import_time("tkinter, mosaic.display, mosaic.scheduler, mosaic.audio, mosaic.frames, "
+                                     "mosaic.tiles, mosaic.blur, mosaic.frame_cache, mosaic.keyframes", runs),
+    }
+
+
+def test_frame(size):
+    # Плавный градиент с шумом, похожий на настоящий кадр, а не на чистый шум
+    width, height = size
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.stack([x * 255 // max(1, width - 1), y * 255 // max(1, height - 1),
+                      (x + y) * 255 // max(1, width + height - 2)], axis=-1)
+    return np.clip(frame + rng.integers(-20, 21, frame.shape), 0, 255).astype(np.uint8)
+
+
+def bench_shuffle(grid, runs):
+    results = {}
+    for resolution in grid["resolutions"]:
+        frame = test_frame(RESOLUTIONS[resolution])
+        for iterations in grid["iterations"]:
+            results["shuffle/%s/it%d" % (resolution, iterations)] = measure(
+                lambda: shuffle_frame(frame, iterations), runs)
+    return results
+
+
+def bench_blur(grid, runs):
+    results = {}
+    for resolution in grid["resolutions"]:
+        frame = test_frame(RESOLUTIONS[resolution])
+        for ksize in grid["kernels"]:
+            for backend in list(BACKENDS) + [None]:
+                # None - способ, который выбирает BlurEngine после калибровки
+                results["blur/%s/k%d/%s" % (resolution, ksize, backend or "auto")] = measure(
+                    lambda: blur_engine.blur(frame, ksize, backend), runs)
+    return results
+
+
+def bench_fetch(grid, runs, media_dir):
+    results = {}
+    for resolution in grid["resolutions"]:
+        for count in grid["clip_counts"]:
+            renderer = MosaicRenderer(make_clips(media_dir, count, resolution))
+            renderer.sampler.wait()  # Замеряем выборку по ключевым кадрам, а не равномерную до готовности индексов
+            try:
+                def fetch():
+                    video_path, video_clip = random.choice(renderer.video_clips)
+                    start_time = renderer.sampler.sample_time(video_path, video_clip)
+                    renderer.cache.fetch(video_path, video_clip.fps, start_time,
+                                         lambda t: renderer.sampler.get_frame(video_path, video_clip, t),
+                                         renderer.size)
+
+                result = measure(fetch, runs * 5)
+                result["cache_hit_rate"] = renderer.cache.hit_rate
+                result["seek_hit_rate"] = renderer.sampler.stats.hit_rate
+                results["fetch/%s/clips%d" % (resolution, count)] = result
+            finally:
+                renderer.close()
+    return results
+
+
+def bench_composite(grid, runs, media_dir):
+    # Кадр мозаики целиком (обновление источников, сборка, размытие) с декодером и с заменителями
+    results = {}
+    for count in grid["composite_clips"]:
+        clip_paths = make_clips(media_dir, count, "480p")
+        proxy_store = ProxyStore(os.path.join(media_dir, "proxy"))
+        for future in proxy_store.ingest(clip_paths):
+            future.result()
+        for name, store in (("decode", None), ("proxy", proxy_store)):
+            renderer = MosaicRenderer(clip_paths, proxy_store=store, composite=True)
+            renderer.sampler.wait()  # Замеряем выборку по ключевым кадрам, а не равномерную до готовности индексов
+            try:
+                result = measure(renderer.next_frame, runs * 2)
+                result["fps"] = 1000.0 / result["median_ms"]
+                results["composite/480p/clips%d/%s" % (count, name)] = result
+            finally:
+                renderer.close()
+    return results
+
+
+def bench_audio(grid, runs, media_dir):
+    from pydub import AudioSegment
+
+    results = {}
+    for seconds in grid["audio_seconds"]:
+        audio = AudioSegment.from_file(make_audio(os.path.join(media_dir, "noise-%d.wav" % seconds), seconds))
+        audio_mosaic = AudioMosaic()
+        results["audio/segments/%ds" % seconds] = measure(lambda: audio_mosaic.convert_audio_to_segments(audio), runs)
+        # Один круг перемешанного звука блоками по 40 мс с переходами на стыках, как при воспроизведении
+        blocks = len(audio_mosaic.offsets) * audio_mosaic.segment_frames // audio_mosaic.stream().block_frames
+
+        def stream_all():
+            stream = audio_mosaic.stream()
+            return sum(len(stream.next_block()) for _ in range(blocks))
+
+        results["audio/shuffle/%ds" % seconds] = measure(stream_all, runs)
+
+        # Секунда сведения K слоев; меньше 1000 мс - успевает в реальном времени на одном ядре
+        for layers in grid["audio_layers"]:
+            audio_mosaic.set_layers(layers)
+            stream = audio_mosaic.stream()
+            per_second = 1000 // BLOCK_MS
+            results["audio/layers%d" % layers] = measure(
+                lambda: [stream.next_block() for _ in range(per_second)], runs)
+    return results
+
+
+def audio_startup(clip_paths, cache=None):
+    # Время от запуска извлечения до первого сегмента, который уже можно играть
+    from moviepy.editor import AudioFileClip
+
+    clips = []
+    for path in clip_paths:
+        audio_clip = AudioFileClip(path)
+        clips.append((path, audio_clip.duration))
+        audio_clip.close()
+    audio_mosaic = AudioMosaic()
+    start = time.perf_counter()
+    extractor = extract_audio(audio_mosaic, clips, cache=cache)
+    # play_audio тоже ждет появления первых сегментов, опрашивая таблицу
+    while not len(audio_mosaic.offsets) and extractor.progress()[0] < len(clips):
+        time.sleep(0.001)
+    first = time.perf_counter() - start
+    extractor.wait()
+    return {"first_ms": first * 1000, "all_ms": (time.perf_counter() - start) * 1000, "clips": len(clips)}
+
+
+def bench_startup(grid, media_dir):
+    results = {}
+    for count in grid["clip_counts"]:
+        clip_paths = make_clips(media_dir, count, "480p")
+        results["startup/clips%d/cold" % count] = audio_startup(clip_paths)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = PcmCache(cache_dir)
+            audio_startup(clip_paths, cache)
+            results["startup/clips%d/cached" % count] = audio_startup(clip_paths, cache)
+    return results
+
+
+def bench_e2e(media_dir):
+    clip_paths = make_clips(media_dir, REFERENCE_CLIPS, "480p")
+    with tempfile.TemporaryDirectory() as out_dir:
+        report = render(clip_paths, os.path.join(out_dir, "bench.mp4"), E2E_SECONDS, CLIP_FPS,
+                        seed=1, with_audio=False)
+    return {"e2e/480p/clips%d" % REFERENCE_CLIPS: {"fps": report["fps"], "frames": report["frames"],
+                                                    "seconds": report["seconds"]}}
+
+
+def bench_batch(grid, media_dir):
+    # Время растет как декод плюс кодирование каждого варианта, а не как N полных записей
+    clip_paths = make_clips(media_dir, REFERENCE_CLIPS, "480p")
+    results = {}
+    for count in grid["batch_variants"]:
+        with tempfile.TemporaryDirectory() as out_dir:
+            report = render_batch(clip_paths, make_variants(out_dir, count, seed=1), E2E_SECONDS, CLIP_FPS,
+                                  seed=1, with_audio=False)
+        results["batch/480p/variants%d" % count] = {
+            "fps": report["fps"], "seconds": report["seconds"], "decode_seconds": report["decode_seconds"],
+            "per_variant_ms": report["per_variant_ms"]}
+    return results
+
+
+def run(stages=STAGES, quick=False, media_dir=None, runs=None):
+    grid = dict(QUICK) if quick else {
+        "resolutions": tuple(RESOLUTIONS), "iterations": tuple(ITERATIONS), "kernels": KERNELS,
+        "clip_counts": CLIP_COUNTS, "composite_clips": COMPOSITE_CLIPS, "audio_seconds": AUDIO_SECONDS,
+        "audio_layers": AUDIO_LAYERS, "batch_variants": BATCH_VARIANTS, "runs": RUNS,
+    }
+    runs = runs or grid["runs"]
+    random.seed(0)
+    np.random.seed(0)
+    permutation_pool.seed(0)
+    media_dir = media_dir or os.path.join(tempfile.gettempdir(), "random-video-mosaic-bench")
+    os.makedirs(media_dir, exist_ok=True)
+
+    results = {}
+    if "import" in stages:
+        results.update(bench_import(max(3, runs // 2)))
+    if "shuffle" in stages:
+        results.update(bench_shuffle(grid, runs))
+    if "blur" in stages:
+        results.update(bench_blur(grid, runs))
+    if "fetch" in stages:
+        results.update(bench_fetch(grid, runs, media_dir))
+    if "composite" in stages:
+        results.update(bench_composite(grid, runs, media_dir))
+    if "audio" in stages:
+        results.update(bench_audio(grid, runs, media_dir))
+    if "startup" in stages or "e2e" in stages:
+        # Итоговые метрики всегда на одном и том же наборе: REFERENCE_CLIPS клипов 480p
+        grid["clip_counts"] = tuple(sorted(set(grid["clip_counts"]) | {REFERENCE_CLIPS}))
+    if "startup" in stages:
+        results.update(bench_startup(grid, media_dir))
+    if "e2e" in stages:
+        results.update(bench_e2e(media_dir))
+    if "batch" in stages:
+        results.update(bench_batch(grid, media_dir))
+
+    metrics = {}
+    render_import = results.get("import/mosaic.render")
+    if render_import:
+        metrics["render_import_ms"] = render_import["median_ms"]
+    startup = results.get("startup/clips%d/cold" % REFERENCE_CLIPS)
+    if startup:
+        metrics["audio_startup_ms"] = startup["first_ms"]
+    e2e = results.get("e2e/480p/clips%d" % REFERENCE_CLIPS)
+    if e2e:
+        metrics["end_to_end_fps"] = e2e["fps"]
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "quick": quick,
+            "runs": runs,
+        },
+        "metrics": metrics,
+        "stages": results,
+    }
+
+
+def primary(result):
+    # Главное число каждого этапа для сравнения: медиана, время до первого звука или кадр/с
+    for key in ("median_ms", "first_ms", "fps"):
+        if key in result:
+            return key, result[key]
+    return None, None
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Список регрессий (имя, эталон, сейчас, изменение); сравниваются только общие с эталоном этапы
+    regressions = []
+    values = [(name, value, baseline["metrics"].get(name), name in HIGHER_IS_BETTER)
+              for name, value in results["metrics"].items()]
+    for name, result in results["stages"].items():
+        key, value = primary(result)
+        base = baseline["stages"].get(name)
+        values.append((name, value, base and base.get(key), key == "fps"))
+    for name, value, base, higher_is_better in values:
+        if value is None or not base:
+            continue
+        change = value / base - 1
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append((name, base, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры всех этапов видео-мозаики на синтетических клипах")
+    parser.add_argument("-o", "--output", help="куда записать результаты в JSON (по умолчанию - в вывод)")
+    parser.add_argument("--baseline", help="JSON с эталонными результатами для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="допустимое замедление относительно эталона, доля")
+    parser.add_argument("--stages", default=",".join(STAGES), help="этапы через запятую: " + ", ".join(STAGES))
+    parser.add_argument("--quick", action="store_true", help="малая сетка параметров, только 480p")
+    parser.add_argument("--runs", type=int, default=None, help="повторов на каждую точку")
+    parser.add_argument("--media-dir", help="где хранить синтетические клипы между запусками")
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error("неизвестные этапы: %s" % ", ".join(sorted(unknown)))
+
+    results = run(stages, args.quick, args.media_dir, args.runs)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    for name, value in results["metrics"].items():
+        print("%s: %.2f" % (name, value), file=sys.stderr)
+
+    status = 0
+    if results["metrics"].get("render_import_ms", 0) > IMPORT_TARGET * 1000:
+        print("ЦЕЛЬ НЕ ДОСТИГНУТА: импорт mosaic.render %.0f мс, цель %.0f мс" % (
+            results["metrics"]["render_import_ms"], IMPORT_TARGET * 1000), file=sys.stderr)
+        status = 1
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for name, base, value, change in regressions:
+            print("РЕГРЕССИЯ %s: %.3f -> %.3f (%+.0f%%)" % (name, base, value, change * 100), file=sys.stderr)
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
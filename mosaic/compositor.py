@@ -0,0 +1,114 @@
+import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mosaic.frames import OUTPUT_SIZE
+from mosaic.metrics import metrics
+from mosaic.tiles import PLITKOREZ, grid_size, permutation_pool
+
+MAX_SOURCES = 32  # Сколько последних кадров разных клипов участвуют в одном кадре мозаики
+REFRESH_PER_FRAME = 4  # Сколько источников обновляется на каждом кадре (декодов на кадр)
+DECODE_WORKERS = 4
+
+
+class TileCompositor:
+    # Каждая плитка результата берется из своего источника: последнего декодированного кадра
+    # одного из клипов. Источники обновляются по несколько на кадр, запросы группируются по клипу:
+    # один декодер за раз читает свои кадры по возрастанию времени, разные клипы декодируются параллельно.
+    # Один декодированный кадр отдает все плитки, которые достались его источнику.
+    def __init__(self, video_clips, sampler, cache, size=OUTPUT_SIZE, proxy_store=None,
+                 max_sources=MAX_SOURCES, refresh=REFRESH_PER_FRAME, workers=DECODE_WORKERS):
+        self.video_clips = list(video_clips)
+        self.sampler = sampler
+        self.cache = cache
+        self.size = size
+        self.proxy_store = proxy_store
+        self.refresh_count = refresh
+        self.workers = workers
+        slots = min(max_sources, len(self.video_clips))
+        width, height = size
+        self.sources = np.zeros((slots, height, width, 3), dtype=np.uint8)
+        self.loaded = np.zeros(slots, dtype=bool)
+        self.next_slot = 0
+        self.out = np.empty((height, width, 3), dtype=np.uint8)
+        self.executor = None
+        self.decodes = 0
+        self.frames = 0
+        metrics.gauge("compositor_decodes_per_frame", lambda: self.decodes / self.frames if self.frames else 0.0)
+
+    def _fetch(self, clip_number, t):
+        video_path, video_clip = self.video_clips[clip_number]
+        if self.proxy_store is not None:
+            frame = self.proxy_store.frame(video_path, t)
+            if frame is not None:
+                return frame
+        return self.cache.fetch(video_path, video_clip.fps, t,
+                                lambda t: self.sampler.get_frame(video_path, video_clip, t), self.size)
+
+    def _decode_clip(self, clip_number, requests):
+        # Все запросы к одному клипу в одном потоке и по возрастанию времени: декодер читает вперед
+        for t, slot in sorted(requests):
+            self.sources[slot] = self._fetch(clip_number, t)
+            self.loaded[slot] = True
+
+    def refresh(self, count=None):
+        # Сначала заполняются пустые источники, затем обновляются по кругу
+        slots = len(self.sources)
+        empty = np.flatnonzero(~self.loaded)
+        if len(empty):
+            chosen = list(empty)
+        else:
+            count = min(slots, count or self.refresh_count)
+            chosen = [(self.next_slot + offset) % slots for offset in range(count)]
+            self.next_slot = (self.next_slot + count) % slots
+
+        requests = defaultdict(list)
+        for slot in chosen:
+            # Пока клипов не больше источников, у каждого источника свой клип
+            clip_number = slot if len(self.video_clips) <= slots else random.randrange(len(self.video_clips))
+            video_path, video_clip = self.video_clips[clip_number]
+            requests[clip_number].append((self.sampler.sample_time(video_path, video_clip), slot))
+
+        with metrics.timed("compositor_decode"):
+            if len(requests) == 1 or self.workers <= 1:
+                for clip_number, clip_requests in requests.items():
+                    self._decode_clip(clip_number, clip_requests)
+            else:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                for future in [self.executor.submit(self._decode_clip, clip_number, clip_requests)
+                               for clip_number, clip_requests in requests.items()]:
+                    future.result()
+        self.decodes += len(chosen)
+
+    def compose(self, rows, cols, levels=None):
+        # Позиции плиток перемешиваются таблицей из пула, источник для плитки выбирается случайно.
+        # Плитки копируются целиком через вид (источник, строка, h, столбец, w), без индекса на пиксель
+        slots, height, width, channels = self.sources.shape
+        _, order = permutation_pool.table(rows, cols, levels)
+        source = permutation_pool.rng.integers(slots, size=(rows, cols))
+        src_row, src_col = np.divmod(np.asarray(order, dtype=np.intp).reshape(rows, cols), cols)
+        h, w = height // rows, width // cols
+        tiles = self.sources[:, :rows * h, :cols * w].reshape(slots, rows, h, cols, w, channels)
+        out_tiles = self.out[:rows * h, :cols * w].reshape(rows, h, cols, w, channels)
+        out_tiles[...] = tiles[source, src_row, :, src_col].transpose(0, 2, 1, 3, 4)
+        # Остаток снизу и справа (480 // 64 = 7, 7 * 64 = 448) - из первого источника на своем месте
+        self.out[rows * h:] = self.sources[0, rows * h:]
+        self.out[:, cols * w:] = self.sources[0, :, cols * w:]
+        return self.out
+
+    def next_frame(self, iterations=6):
+        # Результат лежит в общем буфере и перезаписывается следующим вызовом
+        self.refresh()
+        width, height = self.size
+        rows, cols = grid_size(height, width, iterations)
+        with metrics.timed("compositor_compose"):
+            frame = self.compose(rows, cols, iterations if rows == cols == PLITKOREZ ** iterations else None)
+        self.frames += 1
+        return frame
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,46 @@
+import time
+from collections import deque
+
+import tkinter as tk
+from PIL import Image, ImageTk
+
+from mosaic.frames import OUTPUT_SIZE
+from mosaic.metrics import metrics
+
+FPS_WINDOW = 2.0  # За сколько последних секунд считается частота показа
+
+
+class CanvasDisplay:
+    # Один PhotoImage и один элемент холста на все время работы; каждый кадр только перезаписывает пиксели.
+    # Раньше каждый тик добавлял на холст новый элемент, и список элементов рос без конца.
+    def __init__(self, canvas, size=OUTPUT_SIZE):
+        self.canvas = canvas
+        self.size = size
+        self.photo = ImageTk.PhotoImage("RGB", size)
+        self.item = canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+        canvas.image = self.photo  # Сохранение ссылки на изображение, чтобы избежать сборки мусора
+        self.presented = 0
+        self.times = deque()
+        # Пропущенные кадры считает FrameScheduler (frames_dropped), здесь - только показанные
+        metrics.gauge("display_presented", lambda: self.presented)
+        metrics.gauge("display_fps", lambda: self.fps)
+
+    def show(self, frame):
+        # Вызывать из потока Tk с кадром размера холста: уменьшают его декодер или resize_frame
+        # в потоке подготовки. Image.fromarray - единственная копия кадра до передачи в Tk
+        with metrics.timed("present"):
+            self.photo.paste(Image.fromarray(frame))
+        self.presented += 1
+        now = time.monotonic()
+        self.times.append(now)
+        while self.times and now - self.times[0] > FPS_WINDOW:
+            self.times.popleft()
+
+    @property
+    def fps(self):
+        if len(self.times) < 2 or time.monotonic() - self.times[-1] > FPS_WINDOW:
+            return 0.0  # Показ остановлен
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+    def stats(self):
+        return {"presented": self.presented, "fps": self.fps}
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+from mosaic.frames import OUTPUT_SIZE, frame_index, resize_frame
+from mosaic.metrics import metrics
+
+
+class FrameCache:
+    # Кэш уже уменьшенных кадров: ключ (путь к клипу, номер кадра, размер)
+    def __init__(self, budget_mb=256):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        metrics.gauge("frame_cache_hit_rate", lambda: self.hit_rate)
+        metrics.gauge("frame_cache_mb", lambda: self.nbytes / (1024 * 1024))
+
+    def get(self, key):
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        if frame.nbytes > self.budget:
+            return frame
+        # Кадр общий для всех, кто его достанет из кэша, поэтому только для чтения
+        frame.flags.writeable = False
+        with self.lock:
+            old = self.frames.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.budget:
+                _, evicted = self.frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return frame
+
+    def fetch(self, path, fps, t, decode, size=OUTPUT_SIZE):
+        index = frame_index(fps, t)
+        key = (path, index, size)
+        frame = self.get(key)
+        if frame is None:
+            with metrics.timed("decode"):
+                decoded = decode(index / fps)
+            with metrics.timed("resize"):
+                frame = self.put(key, resize_frame(decoded, size))
+        return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.nbytes = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "frames": len(self.frames),
+            "megabytes": self.nbytes / (1024 * 1024),
+            "budget_megabytes": self.budget / (1024 * 1024),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
@@ -0,0 +1,32 @@
+# moviepy и OpenCV импортируются при первом кадре, а не при запуске: окно появляется сразу
+OUTPUT_SIZE = (640, 480)  # Размер холста (ширина, высота)
+
+# Качество уменьшения: фильтр масштабирования ffmpeg при декодировании и запасной фильтр OpenCV
+RESIZE_FILTERS = {
+    "fast": ("fast_bilinear", "INTER_LINEAR"),
+    "balanced": ("area", "INTER_AREA"),
+    "best": ("lanczos", "INTER_LANCZOS4"),
+}
+RESIZE_QUALITY = "balanced"
+
+
+def frame_index(fps, t):
+    # Тот же '+0.00001', что и в moviepy, чтобы n / fps давал кадр n
+    return int(fps * t + 0.00001)
+
+
+def open_clip(path, size=OUTPUT_SIZE, quality=RESIZE_QUALITY, audio=True):
+    # ffmpeg сам уменьшает кадры до размера холста, полный кадр 4K в Python не попадает.
+    # Не moviepy.editor: тот тянет за собой IPython и все эффекты, это сотни миллисекунд
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+
+    return VideoFileClip(path, target_resolution=(size[1], size[0]),
+                         resize_algorithm=RESIZE_FILTERS[quality][0], audio=audio)
+
+
+def resize_frame(frame, size=OUTPUT_SIZE, quality=RESIZE_QUALITY):
+    if frame.shape[1] == size[0] and frame.shape[0] == size[1]:
+        return frame  # Уже уменьшен декодером
+    import cv2
+
+    return cv2.resize(frame, size, interpolation=getattr(cv2, RESIZE_FILTERS[quality][1]))
@@ -0,0 +1,250 @@
+import bisect
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mosaic.metrics import metrics
+from mosaic.pcm_cache import source_key
+
+# moviepy перед точным поиском отступает на 1 секунду назад (см. FFMPEG_VideoReader.initialize),
+# поэтому самый дешевый кадр после перезапуска декодера лежит через эту секунду после ключевого
+SEEK_OFFSET = 1.0
+# Если новый кадр дальше этого числа кадров вперед, moviepy перезапускает ffmpeg
+MAX_SKIP_FRAMES = 100
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "random-video-mosaic", "keyframes")
+INDEX_WORKERS = 2  # Параллельных поисков ключевых кадров (без ffprobe - ~0.3 с на минуту 1080p)
+RETRY_SECONDS = 5  # Как часто процесс, который сам не ищет, заглядывает в готовые индексы на диске
+
+
+def _probe_keyframes(path):
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe:
+        cmd = [ffprobe, "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path]
+        output = subprocess.run(cmd, capture_output=True, text=True).stdout
+        times = []
+        for line in output.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and pts_time not in ("", "N/A"):
+                times.append(float(pts_time))
+        return times
+
+    # Без ffprobe декодируем только ключевые кадры и читаем их время из showinfo
+    from moviepy.config import get_setting
+
+    cmd = [get_setting("FFMPEG_BINARY"), "-hide_banner", "-nostats", "-skip_frame", "nokey",
+           "-i", path, "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"]
+    output = subprocess.run(cmd, capture_output=True, text=True).stderr
+    return [float(t) for t in re.findall(r"pts_time:(-?[0-9.]+)", output)]
+
+
+class KeyframeIndex:
+    def __init__(self, path, duration, times=None):
+        self.path = path
+        self.duration = duration
+        if times is None:
+            times = _probe_keyframes(path)
+        times = sorted({t for t in times if 0 <= t < duration})
+        # Если ключевые кадры найти не удалось, считаем весь клип одной группой (GOP)
+        self.times = times or [0.0]
+
+    def gop(self, t):
+        i = max(0, bisect.bisect_right(self.times, t) - 1)
+        end = self.times[i + 1] if i + 1 < len(self.times) else self.duration
+        return self.times[i], end
+
+    def random_keyframe(self):
+        return random.choice(self.times)
+
+
+class SeekStats:
+    def __init__(self):
+        self.samples = 0
+        self.seeks = 0  # Перезапуск декодера с поиском
+        self.sequential = 0  # Чтение вперед без перезапуска
+        self.repeats = 0  # Тот же кадр, что и в прошлый раз
+        self.seek_time = 0.0
+        self.sequential_time = 0.0
+
+    @property
+    def hit_rate(self):
+        return (self.samples - self.seeks) / self.samples if self.samples else 0.0
+
+    def as_dict(self):
+        return {
+            "samples": self.samples,
+            "seeks": self.seeks,
+            "sequential": self.sequential,
+            "repeats": self.repeats,
+            "hit_rate": self.hit_rate,
+            "seek_time": self.seek_time,
+            "sequential_time": self.sequential_time,
+        }
+
+
+class SeekAwareSampler:
+    # mode: "uniform" - как раньше, случайное время по всему клипу;
+    #       "keyframe" - сразу после ключевого кадра (один короткий декод);
+    #       "gop" - после ключевого кадра и еще burst кадров вперед внутри той же группы
+    # Индексы строятся в фоне и сохраняются на диск; пока индекса клипа нет, время выбирается
+    # равномерно. probe=False - только читать индексы, готовые у другого процесса (FramePipeline)
+    def __init__(self, mode="gop", burst=4, probe=True, directory=INDEX_DIR):
+        self.mode = mode
+        self.burst = burst
+        self.probe = probe
+        self.directory = directory
+        self.indexes = {}
+        self.durations = {}
+        self.pending = {}
+        self.checked = {}
+        self.keys = {}
+        self.executor = None
+        self.plans = {}
+        self.stats = SeekStats()
+        self.lock = threading.Lock()  # get_frame разных клипов может идти из нескольких потоков
+        metrics.gauge("seek_hit_rate", lambda: self.stats.hit_rate)
+
+    def add_clip(self, path, clip):
+        # Не ждет: можно вызывать из потока Tk для сотен клипов
+        self.durations[path] = clip.duration
+        if self.probe:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=INDEX_WORKERS)
+            self.pending[path] = self.executor.submit(self._build, path, clip.duration)
+
+    def remove_clip(self, path):
+        self.indexes.pop(path, None)
+        self.durations.pop(path, None)
+        self.pending.pop(path, None)
+        self.plans.pop(path, None)
+
+    def _index_path(self, path):
+        key = self.keys.get(path)
+        if key is None:
+            key = self.keys[path] = source_key(path, "keyframes")
+        return os.path.join(self.directory, key + ".json")
+
+    def _load(self, path, duration):
+        try:
+            with open(self._index_path(path), encoding="utf-8") as index_file:
+                return KeyframeIndex(path, duration, json.load(index_file)["times"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _build(self, path, duration):
+        index = self._load(path, duration)
+        if index is None:
+            try:
+                with metrics.timed("keyframe_probe"):
+                    index = KeyframeIndex(path, duration)
+            except Exception:
+                # Без индекса клип - одна группа; записываем и ее, чтобы обработчики не ждали
+                metrics.count("keyframe_probe_errors")
+                index = KeyframeIndex(path, duration, [])
+            index_path = self._index_path(path)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(index_path + ".tmp", "w", encoding="utf-8") as index_file:
+                    json.dump({"source": os.path.abspath(path), "times": index.times}, index_file)
+                os.replace(index_path + ".tmp", index_path)
+            except OSError:
+                pass
+        if path in self.durations:
+            self.indexes[path] = index
+
+    def _index(self, path):
+        index = self.indexes.get(path)
+        if index is None and not self.probe and path in self.durations:
+            now = time.monotonic()
+            if now - self.checked.get(path, -RETRY_SECONDS) >= RETRY_SECONDS:
+                self.checked[path] = now
+                index = self._load(path, self.durations[path])
+                if index is not None:
+                    self.indexes[path] = index
+        return index
+
+    def ready(self):
+        return sum(path in self.indexes for path in self.durations), len(self.durations)
+
+    def wait(self, timeout=None):
+        # Для записи с зерном: выбор времени не должен зависеть от того, успели ли индексы
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for future in list(self.pending.values()):
+            future.result(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        while not self.probe:
+            missing = [path for path in self.durations if path not in self.indexes]
+            for path in missing:
+                index = self._load(path, self.durations[path])
+                if index is not None:
+                    self.indexes[path] = index
+            if len(missing) == 0 or (deadline is not None and time.monotonic() > deadline):
+                break
+            time.sleep(0.1)
+        return self.ready()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _last_time(self, clip):
+        return max(0.0, clip.duration - 1)
+
+    def _seek_target(self, keyframe, clip):
+        return min(keyframe + min(SEEK_OFFSET, keyframe), self._last_time(clip))
+
+    def sample_time(self, path, clip):
+        index = self._index(path)
+        if index is None or self.mode == "uniform":
+            return random.uniform(0, self._last_time(clip))
+
+        if self.mode == "keyframe":
+            return self._seek_target(index.random_keyframe(), clip)
+
+        plan = self.plans.get(path)
+        if not plan:
+            keyframe = index.random_keyframe()
+            start = self._seek_target(keyframe, clip)
+            _, end = index.gop(start)
+            end = min(max(end, start), self._last_time(clip))
+            # pop() берет с конца: сначала start, затем остальные по возрастанию
+            plan = sorted((random.uniform(start, end) for _ in range(self.burst - 1)), reverse=True)
+            plan.append(start)
+            self.plans[path] = plan
+        return plan.pop()
+
+    def get_frame(self, path, clip, t=None):
+        if t is None:
+            t = self.sample_time(path, clip)
+
+        # Клип из ReaderPool может быть без открытого декодера: тогда чтение начнется с поиска
+        reader = clip.reader
+        pos = int(clip.fps * t + 0.00001) + 1
+        if reader is None or reader.proc is None or pos < reader.pos or pos > reader.pos + MAX_SKIP_FRAMES:
+            kind = "seek"
+        elif pos == reader.pos:
+            kind = "repeat"
+        else:
+            kind = "sequential"
+
+        start = time.perf_counter()
+        frame = clip.get_frame(t)
+        elapsed = time.perf_counter() - start
+        metrics.observe("decode_" + kind, elapsed)
+
+        with self.lock:
+            self.stats.samples += 1
+            if kind == "seek":
+                self.stats.seeks += 1
+                self.stats.seek_time += elapsed
+            elif kind == "repeat":
+                self.stats.repeats += 1
+            else:
+                self.stats.sequential += 1
+                self.stats.sequential_time += elapsed
+        return frame
@@ -0,0 +1,269 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+# Границы корзин гистограмм задержек, секунды
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+METRICS_PORT = 9464
+LOG_INTERVAL = 10.0
+PROFILE_INTERVAL = 0.005
+PROFILE_DEPTH = 32
+PROFILE_TOP = 40
+
+
+class Histogram:
+    # Только счетчики по корзинам: запись - поиск корзины и несколько сложений, без хранения значений
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        # Оценка сверху: граница корзины, в которую попал квантиль
+        with self.lock:
+            counts, count, maximum = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for bound, bucket in zip(BUCKETS + (maximum,), counts):
+            seen += bucket
+            if seen >= rank:
+                return min(bound, maximum)
+        return maximum
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.quantile(0.5) * 1000,
+            "p90_ms": self.quantile(0.9) * 1000,
+            "p99_ms": self.quantile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class SamplingProfiler:
+    # Включается по требованию: раз в interval смотрит стеки всех потоков через sys._current_frames()
+    # и считает одинаковые стеки. Сами этапы при этом никак не замедляются.
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self):
+        own = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_DEPTH:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 frame.f_lineno or 0))
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def report(self, top=PROFILE_TOP):
+        # Свернутые стеки "корень;...;лист число" - формат для flamegraph.pl и speedscope
+        with self.lock:
+            stacks = self.stacks.most_common(top)
+        return "".join("%s %d\n" % (stack, count) for stack, count in stacks)
+
+
+class Metrics:
+    # Общий реестр замеров: гистограммы задержек этапов, счетчики и значения, которые снимаются при чтении
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.profiler = SamplingProfiler()
+        self.started = time.time()
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(stage).observe(time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def gauge(self, name, read):
+        # read() вызывается только при чтении замеров: глубина очереди, доля попаданий в кэш и т.п.
+        self.gauges[name] = read
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = float(read())
+            except Exception:
+                continue
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "stages": {stage: histogram.snapshot() for stage, histogram in list(self.histograms.items())},
+            "counters": counters,
+            "gauges": gauges,
+            "profiling": self.profiler.running,
+        }
+
+    def text(self):
+        # Текстовый формат Prometheus, чтобы endpoint читался и глазами, и сборщиками
+        lines = []
+        for stage, histogram in sorted(self.histograms.items()):
+            with histogram.lock:
+                counts, count, total = list(histogram.counts), histogram.count, histogram.total
+            seen = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                seen += bucket
+                lines.append('mosaic_stage_seconds_bucket{stage="%s",le="%g"} %d' % (stage, bound, seen))
+            lines.append('mosaic_stage_seconds_bucket{stage="%s",le="+Inf"} %d' % (stage, count))
+            lines.append('mosaic_stage_seconds_sum{stage="%s"} %.6f' % (stage, total))
+            lines.append('mosaic_stage_seconds_count{stage="%s"} %d' % (stage, count))
+        snapshot = self.snapshot()
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("mosaic_%s_total %d" % (name, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("mosaic_%s %g" % (name, value))
+        lines.append("mosaic_uptime_seconds %.1f" % snapshot["uptime"])
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def serve(port=METRICS_PORT, registry=metrics):
+    # Только на 127.0.0.1: замеры нужны на той же машине, наружу их не открываем.
+    # http.server импортируется здесь: модуль замеров подключают все этапы, а сервер нужен одному окну
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            profiler = registry.profiler
+            if url.path == "/metrics":
+                body = registry.text()
+            elif url.path == "/metrics.json":
+                body = json.dumps(registry.snapshot(), indent=2)
+            elif url.path == "/profile":
+                # /profile?enable=1 - включить, ?enable=0 - выключить, ?reset=1 - начать заново
+                query = parse_qs(url.query)
+                if query.get("reset") == ["1"]:
+                    profiler.reset()
+                if query.get("enable") == ["1"]:
+                    profiler.start()
+                elif query.get("enable") == ["0"]:
+                    profiler.stop()
+                body = "# profiling=%d samples=%d\n%s" % (profiler.running, profiler.samples, profiler.report())
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json" if url.path.endswith(".json")
+                             else "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # Не засоряем консоль запросами сборщика
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class MetricsLogger:
+    # Раз в interval дописывает снимок замеров строкой JSON в файл
+    def __init__(self, path, interval=LOG_INTERVAL, registry=metrics):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            with open(self.path, "a", encoding="utf-8") as log_file:
+                log_file.write(json.dumps(self.registry.snapshot()) + "\n")
+
+    def stop(self):
+        self.running = False
+
+
+def start_metrics():
+    # Настройка через окружение:
+    # MOSAIC_METRICS_PORT - порт endpoint (по умолчанию 9464, 0 - не запускать)
+    # MOSAIC_METRICS_LOG - файл для периодического JSON журнала
+    # MOSAIC_PROFILE=1 - сразу включить профилировщик (иначе /profile?enable=1)
+    port = int(os.environ.get("MOSAIC_METRICS_PORT", METRICS_PORT))
+    if port:
+        try:
+            serve(port)
+        except OSError as error:
+            print("Замеры недоступны по http: порт %d занят (%s)" % (port, error), file=sys.stderr)
+    log_path = os.environ.get("MOSAIC_METRICS_LOG")
+    if log_path:
+        MetricsLogger(log_path, float(os.environ.get("MOSAIC_METRICS_INTERVAL", LOG_INTERVAL)))
+    if os.environ.get("MOSAIC_PROFILE") == "1":
+        metrics.profiler.start()
@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from mosaic.metrics import metrics
+
+PREFETCH_AHEAD = 4  # Сколько шагов вперед по направлению движения готовится заранее
+PREFETCH_CLIPS = 1  # Сколько соседних клипов с каждой стороны готовится на том же кадре
+READY_FRAMES = 48  # Сколько готовых кадров мозаики держать (640x480 - около 44 МБ)
+PREFETCH_WORKERS = 2
+LATENCY_TARGET = 0.05  # Цель: от нажатия до кадра на экране не больше 50 мс
+POLL_MS = 5  # Как часто окно проверяет, готов ли кадр, которого еще не было среди заготовленных
+
+STEPS = {"F": (0, 1), "B": (0, -1), "L": (-1, 0), "R": (1, 0)}  # (клип, кадр)
+
+
+class Navigator:
+    # Положение - отдельно номер клипа и номер кадра в нем. После каждого шага в фоне готовятся
+    # кадры мозаики дальше по направлению движения и тот же кадр соседних клипов, поэтому нажатие
+    # обычно просто показывает готовый кадр. В потоке Tk ничего не декодируется и не размывается:
+    # если нужного кадра еще нет, окно ждет его, не блокируя обработку следующих нажатий.
+    # Если ожидаемый кадр подготовить не удалось, ожидание заканчивается вызовом report_error(положение, ошибка).
+    def __init__(self, widget, video_clips, cache, render, present, speed=1, ahead=PREFETCH_AHEAD,
+                 clips=PREFETCH_CLIPS, ready_frames=READY_FRAMES, workers=PREFETCH_WORKERS, report_error=None):
+        self.widget = widget
+        self.video_clips = video_clips  # Тот же список, что и в окне: новые клипы видны сразу
+        self.cache = cache
+        self.render = render  # Кадр клипа -> кадр мозаики (плитки и размытие)
+        self.present = present
+        self.report_error = report_error
+        self.speed = speed
+        self.ahead = ahead
+        self.clips = clips
+        self.ready_frames = ready_frames
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.clip = 0
+        self.frame = 0
+        self.direction = "F"
+        self.ready = OrderedDict()
+        self.inflight = set()
+        self.failed = {}  # Положение -> ошибка; заново пробуется, только когда на этот кадр переходят
+        self.wanted = frozenset()
+        self.waiting = None  # (положение, время первого еще не показанного нажатия)
+        self.poll_id = None
+        self.hits = 0
+        self.misses = 0
+        self.superseded = 0
+        self.last_error = None  # (клип, кадр, ошибка) последнего неподготовленного кадра
+        self.lock = threading.Lock()
+        self.clip_locks = defaultdict(threading.Lock)  # Один декодер клипа читается одним потоком
+        self.render_lock = threading.Lock()  # Плиткорезка строит индекс пикселей в общем буфере
+        metrics.gauge("navigation_ready", lambda: len(self.ready))
+        metrics.gauge("navigation_hit_rate", lambda: self.hit_rate)
+
+    def frame_count(self, clip):
+        _, video_clip = self.video_clips[clip]
+        return max(1, int(video_clip.duration * video_clip.fps))
+
+    def step(self, position, direction, count=1):
+        clip, frame = position
+        clip_step, frame_step = STEPS[direction]
+        if clip_step:
+            clip = min(max(clip + clip_step * count, 0), len(self.video_clips) - 1)
+        frame = max(0, frame + frame_step * self.speed * count)
+        if frame >= self.frame_count(clip):  # Проверка на границу
+            frame = 0
+        return clip, frame
+
+    def plan(self):
+        # Порядок важности: текущий кадр, шаги по направлению движения, тот же кадр соседних клипов
+        position = (self.clip, self.frame)
+        wanted = [position]
+        for count in range(1, self.ahead + 1):
+            wanted.append(self.step(position, self.direction, count))
+        for offset in range(1, self.clips + 1):
+            wanted.append(self.step(position, "L", offset))
+            wanted.append(self.step(position, "R", offset))
+        return list(OrderedDict.fromkeys(wanted))
+
+    def prefetch(self):
+        # Еще не начатые задачи прошлого плана отменяются, начатые пропускают ненужные кадры.
+        # Кадры одного клипа - одна задача: декодер читает их подряд, разные клипы - параллельно
+        wanted = self.plan()
+        self.wanted = frozenset(wanted)
+        for future in self.futures:
+            future.cancel()
+        requests = OrderedDict()
+        with self.lock:
+            self.failed = {key: error for key, error in self.failed.items() if key in self.wanted}
+            for clip, frame in wanted:
+                if (clip, frame) not in self.ready and (clip, frame) not in self.failed:
+                    requests.setdefault(clip, []).append(frame)
+        self.futures = [self.executor.submit(self._prefetch_clip, clip, frames)
+                        for clip, frames in requests.items()]
+
+    def _prefetch_clip(self, clip, frames):
+        for frame in frames:
+            key = (clip, frame)
+            with self.lock:
+                if key not in self.wanted or key in self.ready or key in self.inflight:
+                    continue
+                self.inflight.add(key)
+            error = None
+            try:
+                image = self._render(clip, frame)
+            except Exception as render_error:
+                metrics.count("navigation_errors")
+                error = repr(render_error)
+                self.last_error = (clip, frame, error)
+                image = None
+            with self.lock:
+                self.inflight.discard(key)
+                if error is not None:
+                    self.failed[key] = error
+                else:
+                    self.ready[key] = image
+                    while len(self.ready) > self.ready_frames:
+                        self.ready.popitem(last=False)
+
+    def _render(self, clip, frame):
+        video_path, video_clip = self.video_clips[clip]
+        with self.clip_locks[video_path], metrics.timed("navigation_decode"):
+            frame_array = self.cache.fetch(video_path, video_clip.fps, frame / video_clip.fps,
+                                           video_clip.get_frame)
+        with self.render_lock, metrics.timed("navigation_render"):
+            return self.render(frame_array)
+
+    def move(self, direction):
+        # Вызывать из потока Tk (обработчик клавиш): только сдвиг положения и показ готового кадра
+        pressed = time.perf_counter()
+        if not self.video_clips:
+            return
+        self.direction = direction
+        self.clip, self.frame = self.step((self.clip, self.frame), direction)
+        self.show((self.clip, self.frame), pressed)
+
+    def show(self, position=None, pressed=None):
+        if position is None:
+            position = (self.clip, self.frame)
+        if pressed is None:
+            pressed = time.perf_counter()
+        if self.waiting is not None:
+            # Прошлое нажатие так и не дождалось кадра: задержку считаем от него
+            self.superseded += 1
+            pressed = self.waiting[1]
+        with self.lock:
+            image = self.ready.get(position)
+            if image is not None:
+                self.ready.move_to_end(position)
+            self.failed.pop(position, None)  # На кадр перешли снова - пробуем еще раз
+        self.prefetch()
+        if image is not None:
+            self.hits += 1
+            self._present(image, pressed)
+            return
+        self.misses += 1
+        self.waiting = (position, pressed)
+        if self.poll_id is None:
+            self.poll_id = self.widget.after(POLL_MS, self._poll)
+
+    def _poll(self):
+        self.poll_id = None
+        if self.waiting is None:
+            return
+        position, pressed = self.waiting
+        with self.lock:
+            image = self.ready.get(position)
+            error = self.failed.get(position)
+        if error is not None:
+            # Кадр не будет готов: не ждем дальше, а сообщаем окну
+            self.waiting = None
+            if self.report_error is not None:
+                self.report_error(position, error)
+            return
+        if image is None:
+            self.poll_id = self.widget.after(POLL_MS, self._poll)
+            return
+        self._present(image, pressed)
+
+    def _present(self, image, pressed):
+        self.waiting = None
+        self.present(image)
+
+        def record():
+            # Кадр уже передан Tk и окно перерисовано: задержка от нажатия до экрана
+            latency = time.perf_counter() - pressed
+            metrics.observe("input_to_photon", latency)
+            if latency > LATENCY_TARGET:
+                metrics.count("input_to_photon_late")
+
+        self.widget.after_idle(record)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        latency = metrics.histogram("input_to_photon").snapshot()
+        return {
+            "position": (self.clip, self.frame),
+            "ready": len(self.ready),
+            "hits": self.hits,
+            "misses": self.misses,
+            "superseded": self.superseded,
+            "hit_rate": self.hit_rate,
+            "latency_p50_ms": latency["p50_ms"],
+            "latency_p99_ms": latency["p99_ms"],
+            "latency_target_ms": LATENCY_TARGET * 1000,
+            "last_error": self.last_error,
+        }
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        if self.poll_id is not None:
+            self.widget.after_cancel(self.poll_id)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "random-video-mosaic", "pcm")
+HASH_BYTES = 1024 * 1024  # Сколько байт с начала и с конца файла входят в хэш
+
+
+def source_key(path, *params):
+    # Ключ файла-источника: путь, размер, время изменения, параметры и хэш начала и конца файла
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    digest.update(("%s|%d|%d|%s" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                                    "|".join(str(param) for param in params))).encode("utf-8"))
+    with open(path, "rb") as source_file:
+        digest.update(source_file.read(HASH_BYTES))
+        if stat.st_size > HASH_BYTES:
+            source_file.seek(max(HASH_BYTES, stat.st_size - HASH_BYTES))
+            digest.update(source_file.read(HASH_BYTES))
+    return digest.hexdigest()
+
+
+class PcmCache:
+    # Кэш извлеченного звука на диске: <ключ>.pcm - сырые int16, <ключ>.json - параметры
+    def __init__(self, directory=CACHE_DIR, max_mb=4096):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, sample_rate, channels):
+        return source_key(path, sample_rate, channels)
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".pcm", base + ".json"
+
+    def load(self, path, sample_rate, channels):
+        pcm_path, meta_path = self._paths(self.key(path, sample_rate, channels))
+        try:
+            with open(meta_path, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            # Отмечаем использование для вытеснения давно не нужных записей
+            os.utime(meta_path)
+            return np.memmap(pcm_path, dtype=np.int16, mode="r", shape=(meta["frames"], meta["channels"]))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self, path, pcm, sample_rate, channels):
+        pcm_path, meta_path = self._paths(self.key(path, sample_rate, channels))
+        meta = {
+            "source": os.path.abspath(path),
+            "sample_rate": sample_rate,
+            "channels": channels,
+            "frames": len(pcm),
+            "duration": len(pcm) / sample_rate,
+        }
+        # Пишем во временные файлы и переименовываем, чтобы не оставить половину записи
+        np.ascontiguousarray(pcm, dtype=np.int16).tofile(pcm_path + ".tmp")
+        os.replace(pcm_path + ".tmp", pcm_path)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(self.directory, name)
+                pcm_path = meta_path[:-len(".json")] + ".pcm"
+                try:
+                    entries.append((os.path.getmtime(meta_path), os.path.getsize(pcm_path), pcm_path, meta_path))
+                except OSError:
+                    continue
+
+            total = sum(size for _, size, _, _ in entries)
+            for _, size, pcm_path, meta_path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale_path in (meta_path, pcm_path):
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        pass
+                total -= size
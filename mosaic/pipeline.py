@@ -0,0 +1,163 @@
+import multiprocessing as mp
+import os
+import queue
+import random
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from mosaic.frames import OUTPUT_SIZE
+from mosaic.metrics import metrics
+
+CACHE_MB = 256  # Кэш уменьшенных кадров; у FramePipeline - на все процессы вместе
+
+
+def frame_seed(seed, seq):
+    # Свое зерно у каждого номера кадра, чтобы результат не зависел от того, какой процесс его посчитал
+    return (seed * 1000003 + seq) % 2 ** 32
+
+
+def _worker(clip_paths, clip_infos, cache_mb, shm_name, slots, size, iterations, blur_strength, seed, proxies,
+            composite, tasks, results):
+    import cv2
+    from mosaic.blur import blur_engine
+    from mosaic.proxy import ProxyStore
+    from mosaic.render import MosaicRenderer
+    from mosaic.tiles import permutation_pool
+
+    cv2.setNumThreads(1)  # Параллелим процессами, а не потоками OpenCV
+    permutation_pool.seed(seed)  # Одинаковые таблицы перестановок во всех процессах
+    # Способ размытия по замеру скорости в каждом процессе мог бы выйти свой
+    blur_engine.set_stable(seed is not None)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = np.ndarray((slots, size[1], size[0], 3), dtype=np.uint8, buffer=shm.buf)
+    # Заменители готовит главный процесс, здесь они только подхватываются с диска
+    proxy_store = ProxyStore(size=size) if proxies else None
+    renderer = MosaicRenderer(clip_paths, iterations, blur_strength, size, cache_mb, proxy_store=proxy_store,
+                              composite=composite, probe=False, clip_infos=clip_infos)
+    if seed is not None:
+        # Индексы ключевых кадров строит главный процесс; с зерном ждем их, чтобы кадр зависел только от номера
+        renderer.sampler.wait()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, slot = task
+            try:
+                if seed is not None:
+                    random.seed(frame_seed(seed, seq))
+                    np.random.seed(frame_seed(seed, seq))
+                    permutation_pool.reseed(frame_seed(seed, seq))
+                    # Серии кадров "gop" тянулись бы из прошлого номера этого процесса: начинаем заново
+                    renderer.sampler.plans.clear()
+                ring[slot] = renderer.next_frame()
+                results.put((seq, slot, None))
+            except Exception as error:
+                results.put((seq, slot, repr(error)))
+    finally:
+        # Итоги декодеров этого процесса: номер кадра None - не кадр, а статистика для close()
+        results.put((None, None, renderer.readers.stats()))
+        renderer.close()
+        del ring
+        shm.close()
+
+
+class FramePipeline:
+    # Процессы готовят кадры (декод, уменьшение, плитки, размытие) в кольцо слотов общей памяти.
+    # get() отдает кадры строго по порядку номеров; слот освобождается при следующем get().
+    # clip_infos - метаданные клипов по путям (PooledClip.infos), без них каждый процесс читает их сам.
+    # cache_mb делится поровну между процессами
+    def __init__(self, clip_paths, workers=None, slots=None, iterations=6, blur_strength=41,
+                 size=OUTPUT_SIZE, seed=None, proxies=False, composite=False,
+                 clip_infos=None, cache_mb=CACHE_MB):
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = slots or self.workers * 2
+        self.size = size
+        frame_shape = (size[1], size[0], 3)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * int(np.prod(frame_shape)))
+        self.ring = np.ndarray((self.slots,) + frame_shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        # spawn, а не fork: окно к этому моменту уже запустило потоки (предзагрузка, индексы,
+        # замеры), а fork копирует их блокировки в том состоянии, в каком застал
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=_worker, daemon=True,
+                            args=(list(clip_paths), clip_infos, cache_mb / self.workers, self.shm.name,
+                                  self.slots, size, iterations, blur_strength, seed, proxies, composite,
+                                  self.tasks, self.results))
+            for _ in range(self.workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+        self.next_submit = 0
+        self.next_read = 0
+        self.ready = {}
+        self.held = False
+        self.worker_readers = []  # stats() пулов декодеров обработчиков, приходят при закрытии
+        self._submit()
+        metrics.gauge("pipeline_ready", lambda: len(self.ready))
+
+    def _submit(self):
+        while self.next_submit < self.next_read + self.slots:
+            self.tasks.put((self.next_submit, self.next_submit % self.slots))
+            self.next_submit += 1
+
+    def _release(self):
+        if self.held:
+            self.held = False
+            self.next_read += 1
+            self._submit()
+
+    def get(self, timeout=None):
+        # Возвращает (номер, кадр); кадр - вид на слот общей памяти без копирования.
+        # При timeout выбрасывает queue.Empty, если следующий по порядку кадр еще не готов.
+        # Кадр, на котором процесс упал, выбрасывает RuntimeError один раз: номер все равно
+        # считается прочитанным, слот возвращается в кольцо, следующий get() отдает следующий кадр
+        self._release()
+        seq = self.next_read
+        start = time.perf_counter()
+        while seq not in self.ready:
+            done_seq, slot, error = self.results.get(timeout=timeout)
+            if done_seq is None:
+                self.worker_readers.append(error)
+                continue
+            self.ready[done_seq] = (slot, error)
+        slot, error = self.ready.pop(seq)
+        if error is not None:
+            metrics.count("pipeline_errors")
+            self.next_read += 1
+            self._submit()
+            raise RuntimeError("Ошибка в процессе подготовки кадра %d: %s" % (seq, error))
+        metrics.observe("pipeline_wait", time.perf_counter() - start)
+        self.held = True
+        return seq, self.ring[slot]
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        # Читаем итоги до join: процесс не завершится, пока его сообщения не ушли из канала
+        while len(self.worker_readers) < len(self.processes):
+            try:
+                done_seq, _, payload = self.results.get(timeout=5)
+            except queue.Empty:
+                break
+            if done_seq is None:
+                self.worker_readers.append(payload)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        del self.ring
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
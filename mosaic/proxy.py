@@ -0,0 +1,138 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mosaic.frames import OUTPUT_SIZE
+from mosaic.pcm_cache import source_key
+
+PROXY_DIR = os.path.join(os.path.expanduser("~"), ".cache", "random-video-mosaic", "proxy")
+# Кадров в секунду в заменителе; 640x480 занимает ~0.9 МБ на кадр, час при 2 кадр/с - около 6.6 ГБ
+PROXY_FPS = 2
+RETRY_SECONDS = 5  # Как часто заново проверять диск, если заменитель клипа еще не готов
+PROXY_BUDGET_MB = 16384  # Место под заменители; сверх него удаляются давно не нужные
+
+
+class ProxyStore:
+    # Заменители клипов: все кадры сразу в выходном размере как сырой uint8 массив (np.memmap).
+    # Случайный кадр - просто индекс в массиве, без поиска в декодере.
+    def __init__(self, directory=PROXY_DIR, size=OUTPUT_SIZE, fps=PROXY_FPS, workers=1, max_mb=PROXY_BUDGET_MB):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.size = size
+        self.fps = fps
+        self.workers = workers
+        self.proxies = {}
+        self.keys = {}
+        self.checked = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, path):
+        key = self.keys.get(path)
+        if key is None:
+            key = self.keys[path] = source_key(path, self.size[0], self.size[1], self.fps)
+        base = os.path.join(self.directory, key)
+        return base + ".rgb", base + ".json"
+
+    def _open(self, path):
+        frames_path, meta_path = self._paths(path)
+        try:
+            with open(meta_path, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            if not meta["frames"]:
+                return None
+            # Отмечаем использование для вытеснения давно не нужных заменителей
+            os.utime(meta_path)
+            proxy = np.memmap(frames_path, dtype=np.uint8, mode="r",
+                              shape=(meta["frames"], meta["height"], meta["width"], 3))
+        except (OSError, ValueError, KeyError):
+            return None
+        with self.lock:
+            self.proxies[path] = proxy
+        return proxy
+
+    def _transcode(self, path):
+        if self._open(path) is not None:
+            return
+        from moviepy.config import get_setting
+
+        frames_path, meta_path = self._paths(path)
+        width, height = self.size
+        cmd = [get_setting("FFMPEG_BINARY"), "-v", "error", "-y", "-i", path, "-an",
+               "-vf", "fps=%s,scale=%d:%d:flags=area" % (self.fps, width, height),
+               "-pix_fmt", "rgb24", "-f", "rawvideo", frames_path + ".tmp"]
+        if subprocess.run(cmd, stdin=subprocess.DEVNULL).returncode != 0:
+            # Недописанный заменитель может занимать гигабайты
+            try:
+                os.remove(frames_path + ".tmp")
+            except OSError:
+                pass
+            return
+        os.replace(frames_path + ".tmp", frames_path)
+        meta = {
+            "source": os.path.abspath(path),
+            "fps": self.fps,
+            "width": width,
+            "height": height,
+            "frames": os.path.getsize(frames_path) // (width * height * 3),
+        }
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(meta_path + ".tmp", meta_path)
+        self.evict()
+        self._open(path)
+
+    def evict(self):
+        # Как в PcmCache: по времени последнего использования, пока все заменители не влезут в бюджет.
+        # Уже открытый np.memmap удаление файла переживает, следующий _open просто не найдет его
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(self.directory, name)
+                frames_path = meta_path[:-len(".json")] + ".rgb"
+                try:
+                    entries.append((os.path.getmtime(meta_path), os.path.getsize(frames_path), frames_path,
+                                    meta_path))
+                except OSError:
+                    continue
+
+            total = sum(size for _, size, _, _ in entries)
+            for _, size, frames_path, meta_path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale_path in (meta_path, frames_path):
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        pass
+                total -= size
+
+    def ingest(self, paths):
+        # Перекодирует клипы в фоне; плеер переключается на заменитель сам, как только он готов
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return [self.executor.submit(self._transcode, path) for path in paths]
+
+    def ready(self, path):
+        return path in self.proxies
+
+    def frame(self, path, t):
+        proxy = self.proxies.get(path)
+        if proxy is None:
+            # Заменитель мог подготовить другой процесс, поэтому иногда заглядываем на диск
+            now = time.monotonic()
+            if now - self.checked.get(path, -RETRY_SECONDS) < RETRY_SECONDS:
+                return None
+            self.checked[path] = now
+            proxy = self._open(path)
+            if proxy is None:
+                return None
+        return proxy[min(int(t * self.fps), len(proxy) - 1)]
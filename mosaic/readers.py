@@ -0,0 +1,158 @@
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from mosaic.frames import OUTPUT_SIZE, RESIZE_QUALITY, open_clip
+from mosaic.metrics import metrics
+
+MAX_OPEN = 16  # Сколько декодеров (процессов ffmpeg) держать открытыми одновременно
+PROBE_WORKERS = 4  # Сколько клипов читают метаданные одновременно
+
+
+class PooledClip:
+    # Клип, от которого при загрузке известны только метаданные; декодер берется из пула на время чтения.
+    # Снаружи выглядит как VideoFileClip: duration, fps, size, reader, get_frame(t).
+    def __init__(self, pool, path, infos):
+        self.pool = pool
+        self.path = path
+        self.infos = infos  # Можно передать в другой процесс, чтобы он не читал метаданные заново
+        self.duration = infos["video_duration"]
+        self.fps = infos["video_fps"]
+        self.size = tuple(infos["video_size"])
+        # Длительность звука, как ее видит AudioFileClip; None - звука нет
+        self.audio_duration = infos["duration"] if infos.get("audio_found") else None
+
+    @property
+    def reader(self):
+        # Открытый сейчас декодер или None; для SeekAwareSampler None значит, что чтение начнется с поиска
+        clip = self.pool.peek(self.path)
+        return clip.reader if clip is not None else None
+
+    def get_frame(self, t):
+        return self.pool.get_frame(self.path, t)
+
+    def close(self):
+        pass  # Декодерами владеет пул
+
+
+class ReaderPool:
+    # Декодеры открываются по требованию, не больше max_open сразу; вытесняется давно не нужный.
+    # Декодер, из которого сейчас читает другой поток, не закрывается.
+    def __init__(self, max_open=MAX_OPEN, size=OUTPUT_SIZE, quality=RESIZE_QUALITY):
+        self.max_open = max_open
+        self.size = size
+        self.quality = quality
+        self.clips = OrderedDict()
+        self.in_use = Counter()
+        self.opens = 0
+        self.evictions = 0
+        self.hits = 0
+        self.lock = threading.Lock()
+        metrics.gauge("readers_open", lambda: len(self.clips))
+        metrics.gauge("reader_opens", lambda: self.opens)
+        metrics.gauge("reader_evictions", lambda: self.evictions)
+
+    def add(self, path, infos=None):
+        # Только метаданные (один короткий запуск ffmpeg), декодер не открывается.
+        # infos - уже прочитанные метаданные (PooledClip.infos), тогда ffmpeg не запускается
+        if infos is None:
+            from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+            infos = ffmpeg_parse_infos(path)
+        return PooledClip(self, path, infos)
+
+    def add_all(self, paths, workers=PROBE_WORKERS):
+        # Метаданные нескольких клипов параллельно, по порядку путей: (путь, клип, ошибка).
+        # Сотни клипов - это минуты запусков ffmpeg, поэтому окна вызывают это не в потоке Tk
+        def probe(path):
+            try:
+                return path, self.add(path), None
+            except Exception as error:
+                return path, None, error
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(probe, paths)
+
+    def peek(self, path):
+        return self.clips.get(path)
+
+    def _evict(self):
+        # Под self.lock. Возвращает закрываемые клипы: close() ждет процесс ffmpeg, это делаем без блокировки
+        closing = []
+        for path in list(self.clips):
+            if len(self.clips) <= self.max_open:
+                break
+            if self.in_use[path]:
+                continue
+            closing.append(self.clips.pop(path))
+            self.evictions += 1
+        return closing
+
+    def acquire(self, path):
+        with self.lock:
+            clip = self.clips.get(path)
+            if clip is not None:
+                self.clips.move_to_end(path)
+                self.in_use[path] += 1
+                self.hits += 1
+                return clip
+
+        # Открываем без блокировки, чтобы другие потоки читали свои клипы; звук читается отдельно
+        clip = open_clip(path, self.size, self.quality, audio=False)
+        with self.lock:
+            existing = self.clips.get(path)
+            if existing is not None:
+                # Другой поток успел открыть тот же клип
+                self.in_use[path] += 1
+                closing = [clip]
+                clip = existing
+            else:
+                self.clips[path] = clip
+                self.in_use[path] += 1
+                self.opens += 1
+                closing = self._evict()
+        for stale in closing:
+            stale.close()
+        return clip
+
+    def release(self, path):
+        with self.lock:
+            self.in_use[path] -= 1
+            if not self.in_use[path]:
+                del self.in_use[path]
+            closing = self._evict()
+        for stale in closing:
+            stale.close()
+
+    def get_frame(self, path, t):
+        clip = self.acquire(path)
+        try:
+            return clip.get_frame(t)
+        finally:
+            self.release(path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "open": len(self.clips),
+                "max_open": self.max_open,
+                "opens": self.opens,
+                "evictions": self.evictions,
+                "hits": self.hits,
+            }
+
+    def close(self):
+        with self.lock:
+            clips = list(self.clips.values())
+            self.clips.clear()
+        for clip in clips:
+            clip.close()
+
+
+def merge_stats(stats):
+    # Сумма stats() нескольких пулов: главного процесса и обработчиков FramePipeline
+    merged = {"open": 0, "max_open": 0, "opens": 0, "evictions": 0, "hits": 0}
+    for pool_stats in stats:
+        for name in merged:
+            merged[name] += pool_stats.get(name, 0)
+    return merged
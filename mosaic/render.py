@@ -0,0 +1,206 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from mosaic.audio import AudioMosaic, extract_audio
+from mosaic.blur import blur_engine, blur_frame
+from mosaic.compositor import TileCompositor
+from mosaic.frame_cache import FrameCache
+from mosaic.frames import OUTPUT_SIZE
+from mosaic.keyframes import SeekAwareSampler
+from mosaic.pcm_cache import PcmCache
+from mosaic.pipeline import CACHE_MB, FramePipeline
+from mosaic.proxy import ProxyStore
+from mosaic.readers import MAX_OPEN, ReaderPool, merge_stats
+from mosaic.tiles import permutation_pool, shuffle_frame
+
+
+def mosaic_frame(frame_array, iterations=6, blur_strength=41, out=None):
+    # Та же цепочка, что и в display_random_frame: плитки, затем размытие.
+    # out - буфер для плиток; без размытия он же и результат
+    shuffled_frame = shuffle_frame(frame_array, iterations, out)
+    if blur_strength:
+        return blur_frame(shuffled_frame, blur_strength)
+    return shuffled_frame
+
+
+class MosaicRenderer:
+    def __init__(self, clip_paths, iterations=6, blur_strength=41, size=OUTPUT_SIZE, cache_mb=CACHE_MB,
+                 proxy_store=None, composite=False, max_open=MAX_OPEN, probe=True, clip_infos=None):
+        self.iterations = iterations
+        self.blur_strength = blur_strength
+        self.size = size
+        self.proxy_store = proxy_store
+        self.sampler = SeekAwareSampler(probe=probe)  # Индексы ключевых кадров строятся в фоне
+        self.cache = FrameCache(budget_mb=cache_mb)
+        # При загрузке только метаданные; декодеры открываются по требованию, не больше max_open
+        self.readers = ReaderPool(max_open, size)
+        self.video_clips = []
+        clip_infos = clip_infos or {}
+        for video_path in clip_paths:
+            video_clip = self.readers.add(video_path, clip_infos.get(video_path))
+            self.video_clips.append((video_path, video_clip))
+            self.sampler.add_clip(video_path, video_clip)
+        # composite - каждая плитка из своего клипа, а не все плитки кадра из одного
+        self.compositor = TileCompositor(self.video_clips, self.sampler, self.cache, size,
+                                         proxy_store) if composite else None
+        self.shuffled = None  # Плитки перед размытием: промежуточный кадр, буфер один на все кадры
+
+    def next_frame(self):
+        if self.compositor is not None:
+            frame = self.compositor.next_frame(self.iterations)
+            return blur_frame(frame, self.blur_strength) if self.blur_strength else frame
+
+        frame_array = self.next_source()
+        if not self.blur_strength:
+            return mosaic_frame(frame_array, self.iterations, 0)  # Плитки и есть результат - новый кадр
+        if self.shuffled is None or self.shuffled.shape != frame_array.shape:
+            self.shuffled = np.empty(frame_array.shape, dtype=np.uint8)
+        return mosaic_frame(frame_array, self.iterations, self.blur_strength, self.shuffled)
+
+    def next_source(self):
+        # Кадр случайного клипа в случайный момент, уже размера холста, до плиток и размытия
+        video_path, video_clip = random.choice(self.video_clips)
+        if self.proxy_store is not None:
+            # С готовым заменителем любое время - просто индекс, поиск по ключевым кадрам не нужен
+            frame_array = self.proxy_store.frame(video_path, random.uniform(0, max(0, video_clip.duration - 1)))
+            if frame_array is not None:
+                return frame_array
+
+        start_time = self.sampler.sample_time(video_path, video_clip)
+        return self.cache.fetch(video_path, video_clip.fps, start_time,
+                                lambda t: self.sampler.get_frame(video_path, video_clip, t), self.size)
+
+    def clip_infos(self):
+        return {video_path: video_clip.infos for video_path, video_clip in self.video_clips}
+
+    def audio_mosaic(self):
+        clips = [(video_path, video_clip.audio_duration) for video_path, video_clip in self.video_clips
+                 if video_clip.audio_duration is not None]
+        if not clips:
+            return None
+        audio_mosaic = AudioMosaic()
+        extract_audio(audio_mosaic, clips, cache=PcmCache()).wait()
+        return audio_mosaic
+
+    def close(self):
+        if self.compositor is not None:
+            self.compositor.close()
+        self.sampler.close()
+        self.readers.close()
+
+
+def render(clip_paths, output_path, duration=60, fps=25, iterations=6, blur_strength=41,
+           seed=None, with_audio=True, codec="libx264", preset="veryfast", workers=0, proxies=False,
+           composite=False, max_open=MAX_OPEN, audio_layers=1):
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+    random.seed(seed)
+    np.random.seed(seed)
+    permutation_pool.seed(seed)
+    blur_engine.set_stable(seed is not None)  # С зерном способ размытия не зависит от замеров скорости
+
+    proxy_store = None
+    if proxies:
+        # Один раз перекодируем клипы в заменители, дальше случайный кадр - индекс в массиве
+        proxy_store = ProxyStore()
+        for future in proxy_store.ingest(clip_paths):
+            future.result()
+
+    renderer = MosaicRenderer(clip_paths, iterations, blur_strength, proxy_store=proxy_store,
+                              composite=composite and not workers, max_open=max_open)
+    pipeline = None
+    if workers:
+        # Обработчики получают уже прочитанные метаданные клипов, а не запускают ffmpeg заново
+        pipeline = FramePipeline(clip_paths, workers, iterations=iterations, blur_strength=blur_strength,
+                                 seed=seed, proxies=proxies, composite=composite,
+                                 clip_infos=renderer.clip_infos())
+    # Без окна ждать некому; а с зерном выбор кадров не должен зависеть от того, успели ли индексы.
+    # Обработчики FramePipeline берут эти же индексы с диска
+    renderer.sampler.wait()
+    audio_path = None
+    try:
+        if with_audio:
+            audio_mosaic = renderer.audio_mosaic()
+            if audio_mosaic is not None:
+                audio_mosaic.set_layers(audio_layers)
+                with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio_file:
+                    audio_path = temp_audio_file.name
+                audio_mosaic.write_wav(audio_path, duration)
+
+        frame_count = int(round(duration * fps))
+        writer = FFMPEG_VideoWriter(output_path, renderer.size, fps, codec=codec,
+                                    audiofile=audio_path, preset=preset)
+        start = time.perf_counter()
+        try:
+            for _ in range(frame_count):
+                if pipeline is not None:
+                    writer.write_frame(pipeline.get()[1])
+                else:
+                    writer.write_frame(renderer.next_frame())
+        finally:
+            writer.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+        renderer.close()
+        if audio_path:
+            os.remove(audio_path)
+
+    return {
+        "frames": frame_count,
+        "seconds": elapsed,
+        "fps": frame_count / elapsed if elapsed else 0.0,
+        "realtime": (frame_count / fps) / elapsed if elapsed else 0.0,
+        "seek": renderer.sampler.stats.as_dict(),
+        "cache": renderer.cache.stats(),
+        # С обработчиками кадры декодируют их пулы, главный только извлекает звук
+        "readers": merge_stats([renderer.readers.stats()] + (pipeline.worker_readers if pipeline is not None else [])),
+    }
+
+
+def odd_kernel(value):
+    value = int(value)
+    if value and value % 2 == 0:
+        raise argparse.ArgumentTypeError("размер ядра размытия должен быть нечетным")
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Запись бесконечной видео-мозаики в файл без окна")
+    parser.add_argument("clips", nargs="+", help="исходные видео файлы")
+    parser.add_argument("-o", "--output", default="mosaic.mp4")
+    parser.add_argument("--duration", type=float, default=60.0, help="длительность в секундах")
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--iterations", type=int, default=6, help="итерации плиткорезки")
+    parser.add_argument("--blur", type=odd_kernel, default=41, help="размер ядра размытия, 0 - без размытия")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--no-audio", action="store_true")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="процессы для подготовки кадров, 0 - все в одном процессе")
+    parser.add_argument("--proxy", action="store_true",
+                        help="сначала перекодировать клипы в заменители для быстрого случайного доступа")
+    parser.add_argument("--composite", action="store_true",
+                        help="каждая плитка из своего клипа и момента времени")
+    parser.add_argument("--max-open", type=int, default=MAX_OPEN,
+                        help="сколько декодеров держать открытыми одновременно")
+    parser.add_argument("--audio-layers", type=int, default=1,
+                        help="сколько перемешанных звуковых слоев звучит одновременно")
+    args = parser.parse_args(argv)
+
+    report = render(args.clips, args.output, args.duration, args.fps, args.iterations,
+                    args.blur, args.seed, not args.no_audio, workers=args.workers,
+                    proxies=args.proxy, composite=args.composite, max_open=args.max_open,
+                    audio_layers=args.audio_layers)
+    print("Кадров: %d за %.2f с, %.1f кадр/с (%.1fx реального времени)" % (
+        report["frames"], report["seconds"], report["fps"], report["realtime"]))
+    print("Декодеры: открыто %d раз, вытеснено %d" % (report["readers"]["opens"], report["readers"]["evictions"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from mosaic.metrics import metrics
+
+DEFAULT_FPS = 1.0  # Как раньше: новый кадр раз в секунду
+AHEAD_FRAMES = 4  # Сколько кадров готовится заранее
+STATS_WINDOW = 100  # По скольким последним показам считаются дрожание и опоздание
+POLICIES = ("repeat", "drop")
+
+
+def display_fps():
+    # Частота показа в окне: MOSAIC_FPS=10 - чаще, если машина успевает готовить кадры
+    return float(os.environ.get("MOSAIC_FPS", DEFAULT_FPS))
+
+
+class FrameScheduler:
+    # Показывает кадры по сетке сроков start + n / fps на монотонных часах, а не "через N мс после
+    # прошлого кадра", поэтому медленный кадр не сдвигает все следующие.
+    # Кадры готовит отдельный поток в ограниченную очередь. Если готовых кадров нет к сроку:
+    # "repeat" - показать прошлый кадр еще раз, "drop" - пропустить срок.
+    # Если опоздал сам показ на несколько сроков (skipped): "drop" выбрасывает кадры пропущенных
+    # сроков, "repeat" показывает следующий по очереди.
+    def __init__(self, widget, produce, present, fps=DEFAULT_FPS, ahead=AHEAD_FRAMES, policy="repeat"):
+        if policy not in POLICIES:
+            raise ValueError("Неизвестная политика %r, допустимы: %s" % (policy, ", ".join(POLICIES)))
+        self.widget = widget
+        self.produce = produce
+        self.present = present
+        self.policy = policy
+        self.frames = queue.Queue(maxsize=ahead)
+        self.running = False
+        self.generation = 0
+        self.producer = None
+        self.after_id = None
+        self.set_fps(fps)
+        self._reset_stats()
+        metrics.gauge("frame_queue", self.frames.qsize)
+        metrics.gauge("frames_dropped", lambda: self.dropped)
+        metrics.gauge("frames_repeated", lambda: self.repeated)
+        metrics.gauge("display_jitter_ms", lambda: self.stats()["jitter_ms"])
+
+    def _reset_stats(self):
+        self.presented = 0
+        self.repeated = 0
+        self.dropped = 0
+        self.late = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_error = None
+        self.lateness = deque(maxlen=STATS_WINDOW)
+        self.intervals = deque(maxlen=STATS_WINDOW)
+        self.last_present = None
+        self.last_frame = None
+
+    def set_fps(self, fps):
+        # Новая частота применяется со следующего срока
+        self.fps = float(fps)
+        self.period = 1.0 / self.fps
+        self.start_time = time.monotonic()
+        self.slot = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.generation += 1
+        self._reset_stats()
+        self.start_time = time.monotonic()
+        self.slot = 0
+        # Поток от прошлого запуска мог еще не выйти из produce(); он завершится по номеру запуска
+        self.producer = threading.Thread(target=self._produce_loop, args=(self.generation,), daemon=True)
+        self.producer.start()
+        self._tick()
+
+    def stop(self):
+        self.running = False
+        if self.after_id is not None:
+            self.widget.after_cancel(self.after_id)
+            self.after_id = None
+        # Освобождаем поток, если он ждет места в очереди
+        while True:
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
+
+    def _produce_loop(self, generation):
+        while self.running and self.generation == generation:
+            try:
+                with metrics.timed("produce"):
+                    frame = self.produce()
+            except Exception as error:
+                self.errors += 1
+                self.last_error = repr(error)
+                frame = None
+            if frame is None:
+                time.sleep(self.period)  # Кадров пока нет (не выбраны клипы, не готов обработчик)
+                continue
+            while self.running and self.generation == generation:
+                try:
+                    self.frames.put(frame, timeout=self.period)
+                    break
+                except queue.Full:
+                    continue
+
+    def _tick(self):
+        if not self.running:
+            return
+        now = time.monotonic()
+        # Номер последнего наступившего срока; сроки между прошлым и этим тиком пропущены
+        slot = max(self.slot, int((now - self.start_time) * self.fps))
+        missed = slot - self.slot
+        self.skipped += missed
+        self.slot = slot + 1
+        lateness = now - (self.start_time + slot * self.period)
+        self.lateness.append(lateness)
+        metrics.observe("display_lateness", max(0.0, lateness))
+        if lateness > self.period / 2:
+            self.late += 1
+
+        if self.policy == "drop":
+            for _ in range(min(missed, self.frames.qsize() - 1)):
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    break
+
+        try:
+            frame = self.frames.get_nowait()
+        except queue.Empty:
+            frame = None
+        if frame is not None:
+            self._present(frame, now)
+        elif self.policy == "repeat" and self.last_frame is not None:
+            self._present(self.last_frame, now)
+            self.repeated += 1
+        else:
+            self.dropped += 1
+
+        delay = self.start_time + self.slot * self.period - time.monotonic()
+        self.after_id = self.widget.after(max(1, int(math.ceil(delay * 1000))), self._tick)
+
+    def _present(self, frame, now):
+        self.present(frame)
+        self.last_frame = frame
+        self.presented += 1
+        if self.last_present is not None:
+            self.intervals.append(now - self.last_present)
+        self.last_present = now
+
+    def stats(self):
+        # Дрожание - среднеквадратичное отклонение интервалов между показами от периода, мс
+        intervals = list(self.intervals)
+        lateness = list(self.lateness)
+        jitter = math.sqrt(sum((interval - self.period) ** 2 for interval in intervals) / len(intervals)) \
+            if intervals else 0.0
+        return {
+            "fps": self.fps,
+            "policy": self.policy,
+            "presented": self.presented,
+            "repeated": self.repeated,
+            "dropped": self.dropped,
+            "late": self.late,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "queued": self.frames.qsize(),
+            "jitter_ms": jitter * 1000,
+            "lateness_mean_ms": sum(lateness) / len(lateness) * 1000 if lateness else 0.0,
+            "lateness_max_ms": max(lateness) * 1000 if lateness else 0.0,
+        }
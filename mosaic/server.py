@@ -0,0 +1,362 @@
+import argparse
+import itertools
+import json
+import random
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from mosaic.metrics import metrics
+from mosaic.pipeline import FramePipeline
+from mosaic.proxy import ProxyStore
+from mosaic.render import MosaicRenderer, odd_kernel
+from mosaic.tiles import permutation_pool
+
+STREAM_PORT = 8090
+JPEG_QUALITY = 80
+AUDIO_HISTORY = 25  # Блоков звука (по 40 мс) в общем буфере: столько может отстать клиент, не теряя звук
+SEND_TIMEOUT = 10.0  # Клиент, который столько секунд не принимает данные, отключается
+READ_TIMEOUT = 1.0  # Как часто поток клиента просыпается без новых кадров (проверить, не остановлен ли сервер)
+REQUEST_QUEUE = 1024  # Очередь еще не принятых соединений: сотни клиентов подключаются разом
+BOUNDARY = b"mosaicframe"
+
+PAGE = b"""<!doctype html>
+<html><head><meta charset="utf-8"><title>random video mosaic</title>
+<style>body{margin:0;background:#000}img{width:100vw;height:100vh;object-fit:contain}</style></head>
+<body><img src="/mjpeg"><audio src="/audio.wav" autoplay></audio></body></html>
+"""
+
+
+class Broadcast:
+    # Последние history сообщений с номерами. Пишет один поток, читает сколько угодно клиентов,
+    # и никто из читателей не задерживает ни писателя, ни других читателей. Отставший больше
+    # чем на history сообщений клиент пропускает старые - это и есть сброс кадров медленным клиентам
+    def __init__(self, history=1):
+        self.items = deque(maxlen=history)
+        self.seq = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def publish(self, payload):
+        with self.condition:
+            self.seq += 1
+            self.items.append((self.seq, payload))
+            self.condition.notify_all()
+
+    def start(self):
+        # Номер, с которого читать новому клиенту: со свежего сообщения, а не со всей истории
+        with self.condition:
+            return max(0, self.seq - 1)
+
+    def read(self, after, timeout=READ_TIMEOUT):
+        # (последний номер, сообщения после after, сколько пропущено); пустой список - таймаут или закрыт
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > after or self.closed, timeout)
+            if self.seq <= after:
+                return after, [], 0
+            items = [payload for seq, payload in self.items if seq > after]
+            return self.seq, items, self.seq - after - len(items)
+
+    def latest(self):
+        with self.condition:
+            return self.items[-1][1] if self.items else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class ClientStats:
+    def __init__(self, number, address, path):
+        self.number = number
+        self.address = address
+        self.path = path
+        self.connected = time.time()
+        self.bytes = 0
+        self.messages = 0
+        self.dropped = 0
+
+    def as_dict(self):
+        seconds = max(time.time() - self.connected, 1e-6)
+        return {
+            "client": self.number,
+            "address": "%s:%d" % self.address,
+            "path": self.path,
+            "seconds": round(seconds, 1),
+            "bytes": self.bytes,
+            "messages": self.messages,
+            "dropped": self.dropped,
+            "mbit_per_s": self.bytes * 8 / seconds / 1e6,
+            "per_s": self.messages / seconds,
+        }
+
+
+class MosaicStream:
+    # Один поток делает кадры мозаики и один раз сжимает каждый в JPEG, второй собирает звук
+    # блоками; оба выкладывают результат в общие буферы, откуда его забирают все клиенты
+    def __init__(self, next_frame, fps=25, quality=JPEG_QUALITY, audio_mosaic=None):
+        self.next_frame = next_frame
+        self.fps = fps
+        self.quality = quality
+        self.audio_mosaic = audio_mosaic
+        self.video = Broadcast(1)
+        self.audio = Broadcast(AUDIO_HISTORY)
+        self.running = False
+        self.threads = []
+        self.clients = {}
+        self.finished = deque(maxlen=100)  # Итоги недавно отключившихся клиентов
+        self.numbers = itertools.count(1)
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.late = 0
+        self.errors = 0
+        self.last_error = None
+        metrics.gauge("stream_clients", lambda: len(self.clients))
+        metrics.gauge("stream_frames", lambda: self.frames)
+
+    def start(self):
+        self.running = True
+        targets = [self._video_loop] + ([self._audio_loop] if self.audio_mosaic is not None else [])
+        self.threads = [threading.Thread(target=target, daemon=True) for target in targets]
+        for thread in self.threads:
+            thread.start()
+
+    def _video_loop(self):
+        import cv2
+
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        interval = 1.0 / self.fps
+        deadline = time.perf_counter()
+        while self.running:
+            try:
+                frame = self.next_frame()
+                with metrics.timed("stream_encode"):
+                    # Кадры мозаики в RGB, OpenCV ждет BGR
+                    ok, data = cv2.imencode(".jpg", np.ascontiguousarray(frame[:, :, ::-1]), params)
+                if ok:
+                    self.video.publish(data.tobytes())
+                    self.frames += 1
+            except Exception as error:
+                # Один неудачный кадр не останавливает раздачу: клиенты просто дольше видят прошлый
+                self.errors += 1
+                self.last_error = repr(error)
+                metrics.count("stream_errors")
+            deadline += interval
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -interval:
+                # Не успеваем: не пытаемся догнать пачкой кадров, просто идем дальше с меньшей частотой
+                self.late += 1
+                metrics.count("stream_late_frames")
+                deadline = time.perf_counter()
+
+    def _audio_loop(self):
+        stream = self.audio_mosaic.stream()
+        interval = stream.block_frames / self.audio_mosaic.sample_rate
+        deadline = time.perf_counter()
+        silence = np.zeros((stream.block_frames, self.audio_mosaic.channels), dtype=np.int16).tobytes()
+        while self.running:
+            try:
+                block = stream.next_block()
+                # None - звук еще извлекается: клиенты получают тишину, а не обрыв потока
+                self.audio.publish(silence if block is None else block.tobytes())
+            except Exception as error:
+                self.errors += 1
+                self.last_error = repr(error)
+                metrics.count("stream_errors")
+                self.audio.publish(silence)
+            deadline += interval
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -interval * AUDIO_HISTORY:
+                deadline = time.perf_counter()
+
+    def wav_header(self):
+        # Заголовок WAV бесконечной длины: размер данных - максимальный, плееры читают до конца потока
+        channels = self.audio_mosaic.channels
+        rate = self.audio_mosaic.sample_rate
+        width = self.audio_mosaic.sample_width
+        size = 0xFFFFFFFF - 36
+        return (b"RIFF" + struct.pack("<I", size + 36) + b"WAVEfmt " +
+                struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * channels * width, channels * width, width * 8) +
+                b"data" + struct.pack("<I", size))
+
+    def connect(self, address, path):
+        client = ClientStats(next(self.numbers), address, path)
+        with self.lock:
+            self.clients[client.number] = client
+        return client
+
+    def disconnect(self, client):
+        with self.lock:
+            self.clients.pop(client.number, None)
+            self.finished.append(client.as_dict())
+
+    def stats(self):
+        with self.lock:
+            clients = [client.as_dict() for client in self.clients.values()]
+            finished = list(self.finished)
+        return {
+            "frames": self.frames,
+            "late_frames": self.late,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "fps": self.fps,
+            "clients": clients,
+            "finished": finished,
+            "encode": metrics.histogram("stream_encode").snapshot(),
+        }
+
+    def close(self):
+        self.running = False
+        self.video.close()
+        self.audio.close()
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+
+def serve(stream, host="127.0.0.1", port=STREAM_PORT):
+    # Поток на клиента: медленный клиент ждет только в своем потоке на записи в сокет,
+    # а из общего буфера получает самый свежий кадр, пропуская те, что не успел взять
+    class Handler(BaseHTTPRequestHandler):
+        timeout = SEND_TIMEOUT
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/":
+                self._send(PAGE, "text/html; charset=utf-8")
+            elif path == "/frame.jpg":
+                data = stream.video.latest()
+                if data is None:
+                    self.send_error(503)
+                    return
+                self._send(data, "image/jpeg")
+            elif path == "/clients.json":
+                self._send(json.dumps(stream.stats(), indent=2).encode("utf-8"), "application/json")
+            elif path == "/mjpeg":
+                self._stream(path, stream.video, "multipart/x-mixed-replace; boundary=" + BOUNDARY.decode(),
+                             self._part)
+            elif path == "/audio.wav" and stream.audio_mosaic is not None:
+                self._stream(path, stream.audio, "audio/wav", lambda data: data, stream.wav_header())
+            else:
+                self.send_error(404)
+
+        def _send(self, data, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(data)
+
+        @staticmethod
+        def _part(data):
+            return b"".join([b"--", BOUNDARY, b"\r\nContent-Type: image/jpeg\r\nContent-Length: ",
+                             str(len(data)).encode(), b"\r\n\r\n", data, b"\r\n"])
+
+        def _stream(self, path, broadcast, content_type, wrap, header=b""):
+            client = stream.connect(self.client_address, path)
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Cache-Control", "no-store")
+                self.end_headers()
+                if header:
+                    self.wfile.write(header)
+                after = broadcast.start()
+                while stream.running:
+                    after, items, dropped = broadcast.read(after)
+                    if dropped:
+                        client.dropped += dropped
+                        metrics.count("stream_dropped", dropped)
+                    for data in items:
+                        # Одна запись на сообщение: wfile без буфера, каждый write - системный вызов
+                        chunk = wrap(data)
+                        self.wfile.write(chunk)
+                        client.bytes += len(chunk)
+                        client.messages += 1
+            except (BrokenPipeError, ConnectionResetError, TimeoutError):
+                pass  # Клиент ушел или перестал читать
+            finally:
+                stream.disconnect(client)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = REQUEST_QUEUE
+        daemon_threads = True
+
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Живая мозаика по http: MJPEG и перемешанный звук для многих зрителей")
+    parser.add_argument("clips", nargs="+", help="исходные видео файлы")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес, 0.0.0.0 - открыть для других машин")
+    parser.add_argument("--port", type=int, default=STREAM_PORT)
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--quality", type=int, default=JPEG_QUALITY, help="качество JPEG, 1-100")
+    parser.add_argument("--iterations", type=int, default=6, help="итерации плиткорезки")
+    parser.add_argument("--blur", type=odd_kernel, default=41, help="размер ядра размытия, 0 - без размытия")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--no-audio", action="store_true")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="процессы для подготовки кадров, 0 - все в одном процессе")
+    parser.add_argument("--proxy", action="store_true",
+                        help="сначала перекодировать клипы в заменители для быстрого случайного доступа")
+    parser.add_argument("--composite", action="store_true",
+                        help="каждая плитка из своего клипа и момента времени")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    permutation_pool.seed(args.seed)
+    proxy_store = None
+    if args.proxy:
+        proxy_store = ProxyStore()
+        for future in proxy_store.ingest(args.clips):
+            future.result()
+    renderer = MosaicRenderer(args.clips, args.iterations, args.blur, proxy_store=proxy_store,
+                              composite=args.composite and not args.workers)
+    pipeline = None
+    if args.workers:
+        pipeline = FramePipeline(args.clips, args.workers, iterations=args.iterations, blur_strength=args.blur,
+                                 seed=args.seed, proxies=args.proxy, composite=args.composite,
+                                 clip_infos=renderer.clip_infos())
+    audio_mosaic = None if args.no_audio else renderer.audio_mosaic()
+
+    next_frame = (lambda: pipeline.get()[1]) if pipeline is not None else renderer.next_frame
+    stream = MosaicStream(next_frame, args.fps, args.quality, audio_mosaic)
+    server = serve(stream, args.host, args.port)
+    stream.start()
+    print("Мозаика: http://%s:%d/ (MJPEG - /mjpeg, звук - /audio.wav, клиенты - /clients.json)" % (
+        args.host, args.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        stream.close()
+        if pipeline is not None:
+            pipeline.close()
+        renderer.close()
+        for client in stream.stats()["finished"]:
+            print("Клиент %(client)d %(path)s: %(seconds).0f с, %(messages)d сообщений, пропущено %(dropped)d, "
+                  "%(mbit_per_s).1f Мбит/с" % client, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import importlib
+import threading
+import time
+
+from mosaic.metrics import metrics
+
+STARTED = time.perf_counter()  # Скрипты импортируют этот модуль первым из пакета
+STARTUP_TARGET = 0.5  # Цель: окно на экране не позже чем через полсекунды после запуска скрипта
+IMPORT_TARGET = 0.3  # Цель для импорта mosaic.render (запись без окна), проверяется в mosaic.bench
+# Что нужно для первого кадра и звука, но не для самого окна
+PRELOAD_MODULES = ("cv2", "moviepy.config", "moviepy.video.io.VideoFileClip", "pygame")
+
+
+def _import_all(modules):
+    for name in modules:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            continue
+        metrics.observe("preload_" + name.split(".")[-1], time.perf_counter() - start)
+
+
+def preload(modules=PRELOAD_MODULES):
+    # Импортирует тяжелые модули в фоне, пока пользователь выбирает файлы: к первому кадру они уже готовы
+    thread = threading.Thread(target=_import_all, args=(modules,), daemon=True)
+    thread.start()
+    return thread
+
+
+def window_shown(root):
+    # Замеряет время от запуска до первого свободного цикла Tk, когда окно уже нарисовано
+    def record():
+        elapsed = time.perf_counter() - STARTED
+        metrics.observe("startup_window", elapsed)
+        if elapsed > STARTUP_TARGET:
+            metrics.count("startup_window_late")
+
+    root.after_idle(record)
@@ -0,0 +1,173 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from mosaic.metrics import metrics
+
+PLITKOREZ = 2  # Во сколько раз мельчает сетка на каждой итерации
+POOL_SIZE = 16  # Сколько готовых перестановок держать для каждой сетки
+INDEX_BUDGET_MB = 192  # Память под готовые индексы пикселей для перестановок из пула
+
+
+def grid_size(height, width, iterations):
+    tiles = PLITKOREZ ** iterations
+    # Плитка не может быть меньше одного пикселя
+    return min(tiles, height), min(tiles, width)
+
+
+def hierarchical_order(rng, levels, base=PLITKOREZ):
+    # Многоуровневая перестановка: на первом уровне перемешиваются base x base блоков кадра,
+    # на каждом следующем - base x base частей внутри каждого блока предыдущего уровня.
+    # Результат - одна плоская перестановка плиток сетки base**levels x base**levels:
+    # order[номер плитки результата] = номер плитки-источника (по строкам).
+    side = base ** levels
+    rows, cols = np.divmod(np.arange(side * side, dtype=np.intp), side)
+    children = base * base
+    parent = np.zeros(side * side, dtype=np.intp)
+    for level in range(levels):
+        scale = base ** (levels - level - 1)
+        child = (rows // scale % base) * base + cols // scale % base
+        # Своя перестановка частей для каждого блока: одна строка таблицы на блок
+        perms = rng.permuted(np.tile(np.arange(children, dtype=np.intp), (children ** level, 1)), axis=1)
+        parent = parent * children + perms[parent, child]
+
+    # Путь по уровням (номер части на каждом уровне) обратно в строку и столбец плитки-источника
+    src_row = np.zeros_like(parent)
+    src_col = np.zeros_like(parent)
+    for level in range(levels):
+        digit = parent // children ** (levels - level - 1) % children
+        src_row = src_row * base + digit // base
+        src_col = src_col * base + digit % base
+    return src_row * side + src_col
+
+
+class PermutationPool:
+    # Перестановки плиток считаются заранее из генератора с зерном и переиспользуются между кадрами;
+    # на кадр остается только выбрать номер таблицы. Одно и то же зерно дает ту же последовательность.
+    def __init__(self, size=POOL_SIZE, seed=None):
+        self.size = size
+        self.tables = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.seed(seed)
+
+    def seed(self, seed):
+        # Таблицы и выбор из них - от одного зерна; таблицы строятся заново
+        with self.lock:
+            self.seed_value = seed
+            self.tables.clear()
+            self.generation += 1  # Индексы пикселей от прошлых таблиц больше не подходят
+        self.rng = np.random.default_rng(seed)
+
+    def reseed(self, seed):
+        # Только выбор таблиц: так процессы с общими таблицами дают один и тот же кадр по его номеру
+        self.rng = np.random.default_rng(seed)
+
+    def _build(self, rows, cols, levels):
+        # Отдельный генератор на каждую сетку, чтобы таблицы не зависели от порядка первых обращений
+        rng = np.random.default_rng([self.seed_value if self.seed_value is not None else
+                                     np.random.SeedSequence().entropy, rows, cols, levels or 0])
+        if levels:
+            return [hierarchical_order(rng, levels) for _ in range(self.size)]
+        return [rng.permutation(rows * cols) for _ in range(self.size)]
+
+    def table(self, rows, cols, levels=None):
+        # (ключ таблицы, перестановка); levels - число уровней, None - одна плоская сетка.
+        # Ключ начинается с (rows, cols), по нему TileShuffler кэширует индекс пикселей
+        key = (rows, cols, levels)
+        tables = self.tables.get(key)
+        if tables is None:
+            with self.lock:
+                tables = self.tables.get(key)
+                if tables is None:
+                    tables = self.tables[key] = self._build(rows, cols, levels)
+        number = int(self.rng.integers(len(tables)))
+        return key + (self.generation, number), tables[number]
+
+
+class TileShuffler:
+    def __init__(self, budget_mb=INDEX_BUDGET_MB):
+        self.shape = None
+        self.grid = None
+        self.index = None
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.indexes = OrderedDict()
+        self.nbytes = 0
+
+    def _prepare(self, shape, rows, cols):
+        if self.shape != shape or self.grid != (rows, cols):
+            height, width, _ = shape
+            self.shape = shape
+            self.grid = (rows, cols)
+            self.index = np.arange(height * width, dtype=np.intp).reshape(height, width)
+
+    def build_index(self, height, width, rows, cols, order):
+        # Индекс пикселя-источника для каждого пикселя результата.
+        # Остаток снизу и справа (480 // 64 = 7, 7 * 64 = 448) остается на месте.
+        h, w = height // rows, width // cols
+        src_row, src_col = np.divmod(np.asarray(order, dtype=np.intp).reshape(rows, cols), cols)
+        y = (src_row * h)[:, None, :, None] + np.arange(h, dtype=np.intp)[None, :, None, None]
+        x = (src_col * w)[:, None, :, None] + np.arange(w, dtype=np.intp)[None, None, None, :]
+        self.index[:rows * h, :cols * w] = (y * width + x).reshape(rows * h, cols * w)
+        return self.index
+
+    def cached_index(self, shape, key, order):
+        # Индекс пикселей для таблицы из пула строится один раз; int32 вдвое меньше intp
+        cache_key = (shape, key)
+        index = self.indexes.get(cache_key)
+        if index is not None:
+            self.indexes.move_to_end(cache_key)
+            return index
+        height, width, _ = shape
+        index = self.build_index(height, width, key[0], key[1], order).astype(np.int32).reshape(-1)
+        self.indexes[cache_key] = index
+        self.nbytes += index.nbytes
+        while self.nbytes > self.budget:
+            _, evicted = self.indexes.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return index
+
+    def shuffle(self, frame, rows, cols, order=None, key=None, out=None):
+        # key - ключ таблицы из PermutationPool: ее индекс пикселей берется из кэша.
+        # Результат - новый кадр или out (uint8 той же формы), если вызывающему удобно переиспользовать свой буфер
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        height, width, channels = frame.shape
+        rows, cols = min(rows, height), min(cols, width)
+        if order is None:
+            key, order = permutation_pool.table(rows, cols)
+
+        self._prepare(frame.shape, rows, cols)
+        # Кэшируем, только если помещаются индексы всего пула (1080p - да, 4K - нет):
+        # при случайном выборе таблиц частичный кэш почти всегда промахивается
+        if key is not None and height * width * 4 * permutation_pool.size <= self.budget:
+            index = self.cached_index(frame.shape, key, order)
+        else:
+            index = self.build_index(height, width, rows, cols, order).reshape(-1)
+
+        if out is None:
+            out = np.empty(frame.shape, dtype=np.uint8)
+        # Одна выборка (gather) всех пикселей сразу
+        np.take(frame.reshape(-1, channels), index, axis=0, out=out.reshape(-1, channels), mode='clip')
+        return out
+
+
+permutation_pool = PermutationPool()
+_shuffler = TileShuffler()
+
+
+def shuffle_grid(frame, rows, cols, order=None, out=None):
+    with metrics.timed("shuffle"):
+        return _shuffler.shuffle(frame, rows, cols, order, out=out)
+
+
+def shuffle_frame(frame, iterations=6, out=None):
+    height, width = frame.shape[:2]
+    rows, cols = grid_size(height, width, iterations)
+    with metrics.timed("shuffle"):
+        if rows == cols == PLITKOREZ ** iterations:
+            key, order = permutation_pool.table(rows, cols, iterations)
+        else:
+            # Сетка упирается в размер кадра, уровни не складываются - одна плоская перестановка
+            key, order = permutation_pool.table(rows, cols)
+        return _shuffler.shuffle(frame, rows, cols, order, key, out)